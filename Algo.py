@@ -40,7 +40,7 @@ def handle_data(context, data):
         
         points = convert_to_points(high_history[security])
         
-        print segmented(points, context.segment_cost)
+        print(segmented(points, context.segment_cost))
         
         slope_high = calc_slope(high_history[security], context.lookback) # O(d)
         slope_low = calc_slope(low_history[security], context.lookback) # O(d)
@@ -139,7 +139,7 @@ def segmented(points,C):
     INF = 99999999999999
     N = len(points)
 
-    print "Got %d points" % N
+    print("Got %d points" % N)
 
     # Multi dimentional array that is N*N in size
     slope = numpy.zeros((N+1, N+1))
@@ -206,7 +206,7 @@ def segmented(points,C):
         opt_segment[j] = k
 
 
-    print "Cost of the optimal solution : %lf" % OPT[N]
+    print("Cost of the optimal solution : %lf" % OPT[N])
 
     # find the optimal solution
     segments = []
@@ -219,13 +219,13 @@ def segmented(points,C):
         i = j-1
         j = opt_segment[i]
 
-    print "\nAn optimal solution :"
+    print("\nAn optimal solution :")
     returns = []
     # O(n)
     while (segments != []):
         i = segments.pop()
         j = segments.pop()
-        print "Segment (y = %f * x + %f) from point #%d: %d %d to point #%d: %d %d with square error %lf." % (slope[i][j], intercept[i][j], i, points[i-1].x, points[i-1].y, j, points[j-1].x, points[j-1].y, E[i][j])
+        print("Segment (y = %f * x + %f) from point #%d: %d %d to point #%d: %d %d with square error %lf." % (slope[i][j], intercept[i][j], i, points[i-1].x, points[i-1].y, j, points[j-1].x, points[j-1].y, E[i][j]))
         returns.append([i-1,j-1])
 
     return returns
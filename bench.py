@@ -0,0 +1,223 @@
+# Benchmarks segmented() across series lengths, segment costs, data shapes and modes, timing
+# each phase of the algorithm and comparing against the C++ reference (segmented.cpp) on the
+# same inputs. Every run appends one JSON record per case to the output file, so runs can be
+# compared against each other with --compare to catch regressions.
+#
+#   python bench.py                              # the default grid, results in bench-results.jsonl
+#   python bench.py --sizes 10 100 1000 --modes dense pruned
+#   python bench.py --compare old.jsonl          # flag cases that got slower than in old.jsonl
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+import segmented
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SIZES = [10, 30, 100, 300, 1000, 3000, 10000]
+COSTS = [1, 10, 1000]
+SHAPES = ['flat', 'trending', 'noisy', 'breakpoints']
+MODES = ['dense', 'low_memory', 'pruned']
+
+# Above these lengths a mode takes too long (or, for dense, too much memory) to be worth timing
+MODE_LIMITS = {'dense': 3000, 'low_memory': 3000, 'pruned': None}
+
+# segmented.cpp keeps its points and matrices in static arrays of MAXN + 1
+CPP_MAXN = 1000
+
+# Integer valued series (the C++ reference only reads ints) of n points with x = 0..n-1
+def make_series(shape, n, seed=0):
+    r = random.Random(seed)
+    if shape == 'flat':
+        y = [100 + r.randint(-1, 1) for k in range(n)]
+    elif shape == 'trending':
+        y = [100 + 2 * k + r.randint(-3, 3) for k in range(n)]
+    elif shape == 'noisy':
+        y = [100 + r.randint(-50, 50) for k in range(n)]
+    elif shape == 'breakpoints':
+        y = []
+        value = 100.0
+        slope = 0.0
+        for k in range(n):
+            if k % 10 == 0:
+                slope = r.uniform(-5, 5)
+            value += slope
+            y.append(int(round(value)) + r.randint(-2, 2))
+    else:
+        raise ValueError("unknown shape %s" % shape)
+    return numpy.arange(n, dtype=float), numpy.array(y, dtype=float)
+
+# Runs one phase, returning its result, wall time and (where tracemalloc can see numpy's
+# allocations) the peak number of bytes it allocated
+def measure(phase, *args):
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = time.time()
+    result = phase(*args)
+    wall = time.time() - start
+    peak = None
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, {'time': wall, 'peak_bytes': peak}
+
+# The phases of segmented() in the given mode, run one by one through the same functions
+def run_phases(x, y, C, mode):
+    N = len(x)
+    phases = {}
+    cumulative, phases['prefix'] = measure(segmented.prefix_sums, x, y)
+    if mode == 'dense':
+        E, phases['errors'] = measure(segmented.error_matrix, cumulative, N)
+        (OPT, opt_segment), phases['opt'] = measure(segmented.opt_recurrence, E, N, C)
+        del E
+    elif mode == 'low_memory':
+        (OPT, opt_segment), phases['opt'] = measure(segmented.opt_recurrence_low_memory, cumulative, N, C)
+    else:
+        (OPT, opt_segment), phases['opt'] = measure(segmented.opt_recurrence_pruned, cumulative, N, C)
+
+    def fit(opt_segment):
+        bounds = segmented.backtrack(opt_segment, N)
+        i, j = numpy.array(bounds).T
+        return bounds, segmented.segment_stats(cumulative, i, j)
+    (bounds, stats), phases['backtrack'] = measure(fit, opt_segment)
+    return float(OPT[N]), len(bounds), phases
+
+# Best wall time of segmented() itself over `repeat` runs, and the profiler report of that run
+def time_segmented(x, y, C, mode, repeat):
+    options = {'pruned': mode == 'pruned', 'low_memory': mode == 'low_memory'}
+    best = report = None
+    for k in range(repeat):
+        reports = []
+        start = time.time()
+        segmented.segmented((x, y), C, profiler=reports.append, **options)
+        wall = time.time() - start
+        if best is None or wall < best:
+            best, report = wall, reports[0]
+    return best, report
+
+# Compiles the C++ reference once, returns the path of the binary or None without a compiler
+def compile_cpp(directory):
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'segmented.cpp')
+    binary = os.path.join(directory, 'segmented')
+    try:
+        subprocess.check_call(['g++', '-O2', '-o', binary, source])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return binary
+
+# Best wall time of the C++ reference (process start and parsing included) and its optimal cost
+def time_cpp(binary, x, y, C, repeat):
+    lines = ["%r" % float(C)] + ["%d %d" % (a, b) for a, b in zip(x, y)]
+    text = ("\n".join(lines) + "\n").encode('ascii')
+    best = None
+    cost = None
+    for k in range(repeat):
+        start = time.time()
+        process = subprocess.Popen([binary], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        output = process.communicate(text)[0].decode('ascii')
+        wall = time.time() - start
+        best = wall if best is None else min(best, wall)
+    for line in output.splitlines():
+        if line.startswith("Cost of the optimal solution"):
+            cost = float(line.split(":")[1])
+    return best, cost
+
+def run(args):
+    records = []
+    directory = tempfile.mkdtemp()
+    try:
+        binary = None if args.no_cpp else compile_cpp(directory)
+        if binary is None and not args.no_cpp:
+            print("g++ is not available, skipping the C++ reference")
+
+        for shape in args.shapes:
+            for n in args.sizes:
+                x, y = make_series(shape, n, args.seed)
+                for C in args.costs:
+                    cpp_wall = cpp_cost = None
+                    if binary is not None and n <= CPP_MAXN:
+                        cpp_wall, cpp_cost = time_cpp(binary, x, y, C, args.repeat)
+
+                    for mode in args.modes:
+                        limit = MODE_LIMITS[mode]
+                        if limit is not None and n > limit:
+                            continue
+                        cost, segments, phases = run_phases(x, y, C, mode)
+                        wall, report = time_segmented(x, y, C, mode, args.repeat)
+                        record = {
+                            'shape': shape, 'n': n, 'cost': C, 'mode': mode,
+                            'wall': wall, 'profile': report, 'candidates': report['candidates'],
+                            'phases': phases, 'segments': segments, 'opt_cost': cost,
+                            'cpp_wall': cpp_wall, 'cpp_cost': cpp_cost,
+                            'cpp_match': None if cpp_cost is None else abs(cpp_cost - cost) <= 1e-4 * max(1.0, abs(cost)),
+                            'python': platform.python_version(), 'numpy': numpy.__version__, 'time': time.time(),
+                        }
+                        records.append(record)
+                        print("%-12s n=%-6d C=%-6g %-10s %9.4fs  segments=%-5d cpp=%s%s" % (
+                            shape, n, C, mode, record['wall'], segments,
+                            "-" if cpp_wall is None else "%.4fs" % cpp_wall,
+                            "" if record['cpp_match'] in (None, True) else "  COST MISMATCH"))
+    finally:
+        shutil.rmtree(directory)
+
+    with open(args.output, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+    return records
+
+# The latest record of every case in an earlier results file
+def load(filename):
+    previous = {}
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                previous[(record['shape'], record['n'], record['cost'], record['mode'])] = record
+    return previous
+
+# Prints every case that is more than `threshold` slower than in the previous results
+def compare(records, previous, threshold):
+    regressions = 0
+    for record in records:
+        old = previous.get((record['shape'], record['n'], record['cost'], record['mode']))
+        if old is not None and record['wall'] > old['wall'] * (1 + threshold):
+            regressions += 1
+            print("REGRESSION %s n=%d C=%g %s: %.4fs -> %.4fs" % (record['shape'], record['n'], record['cost'], record['mode'], old['wall'], record['wall']))
+    print("%d regressions" % regressions)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark segmented() against the C++ reference")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--costs', type=float, nargs='+', default=COSTS)
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=SHAPES)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--repeat', type=int, default=3, help="runs per case, the best one counts")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-cpp', action='store_true', help="don't compile and run segmented.cpp")
+    parser.add_argument('--output', default='bench-results.jsonl', help="JSON Lines file the results are appended to")
+    parser.add_argument('--compare', help="earlier results file to check for regressions against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    # read before running, the baseline may well be the output file itself
+    previous = load(args.compare) if args.compare else None
+    records = run(args)
+    if previous is not None and compare(records, previous, args.threshold) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
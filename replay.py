@@ -0,0 +1,496 @@
+# Replays a Quantopian strategy (segmented.py, Algo.py) offline over daily bars loaded from a
+# file or generated, calling initialize() once and handle_data() every day with local stand-ins
+# for the platform functions, and records for every bar how long it took, how much of that was
+# spent in segmented() and in history(), the memory in use and the orders it sent.
+#
+#   python replay.py segmented.py                            # 500 synthetic securities over 300 days
+#   python replay.py segmented.py --securities 2000 --days 500 --churn 0.2
+#   python replay.py segmented.py --data bars.csv --universe 100 --output bars.jsonl
+#   python replay.py segmented.py --set 'history_cache=HistoryCache(context.lookback)' --set rolling=True
+#
+# CSV files have a header and a row per security and day with date, symbol, open, high, low,
+# close and, optionally, volume columns. .npy files hold a (fields, days, securities) array of
+# open, high, low, close and optionally volume, for securities SEC0, SEC1, ... on the business
+# days from --start-date. A NaN (or, in a CSV, a missing row) is a day a security didn't trade.
+#
+# The universe of each day is the --universe securities (all of them by default) that traded the
+# most in dollars over the lookback, ranked again every --rerank days, and traded on every day of the
+# strategy's lookback. set_universe() only records what the strategy asked for, as a percentile
+# band of a few securities out of thousands makes no sense for a replay. Orders fill at once, in
+# whole shares at the close of the day, without slippage or commissions, so there are never any
+# open orders
+
+import argparse
+import json
+import os
+import sys
+import time
+import types
+
+import numpy
+import pandas
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+FIELDS = ['open', 'high', 'low', 'close', 'volume']
+
+# Module-level functions of the strategy whose calls count as time in segmented(): every
+# segmented*() function and the helpers that segment through RollingSegmenters or a pool
+SEGMENTER_PREFIX = 'segmented'
+SEGMENTER_HELPERS = ('rolling_segments', 'parallel_segments', 'stored_segments')
+
+# Daily bars of every security, one (days, securities) frame per field with NaN on the days a
+# security didn't trade
+class Bars:
+    def __init__(self, frames):
+        self.frames = frames
+        self.dates = frames['close'].index
+        self.securities = list(frames['close'].columns)
+
+    def __len__(self):
+        return len(self.dates)
+
+def load_bars(filename, start_date='2015-01-02'):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.npy':
+        values = numpy.load(filename)
+        if values.ndim != 3 or values.shape[0] not in (4, 5):
+            raise ValueError("%s: expected a (fields, days, securities) array of 4 or 5 fields, got %s" % (filename, values.shape))
+        return array_bars(values, start_date)
+    if extension != '.csv':
+        raise ValueError("%s: expected a .csv or .npy file" % filename)
+
+    rows = pandas.read_csv(filename, parse_dates=['date'])
+    missing = [name for name in ['date', 'symbol'] + FIELDS[:4] if name not in rows.columns]
+    if missing:
+        raise ValueError("%s: missing columns %s" % (filename, ", ".join(missing)))
+    if 'volume' not in rows.columns:
+        rows['volume'] = numpy.nan
+    frames = {}
+    for field in FIELDS:
+        frames[field] = rows.pivot(index='date', columns='symbol', values=field).astype(float)
+    return Bars(frames)
+
+def array_bars(values, start_date='2015-01-02'):
+    fields, days, S = values.shape
+    dates = pandas.bdate_range(start_date, periods=days)
+    securities = ['SEC%d' % s for s in range(S)]
+    frames = {}
+    for n, field in enumerate(FIELDS):
+        frames[field] = pandas.DataFrame(values[n] if n < fields else numpy.nan, index=dates, columns=securities, dtype=float)
+    return Bars(frames)
+
+# Random walks that trend for a few weeks at a time, so the strategy finds some flags. With
+# `churn`, that fraction of the securities only trades between a random day in the first half
+# and a random day in the second half, so securities keep entering and leaving the universe
+def synthetic_bars(securities, days, seed=0, churn=0.0, start_date='2015-01-02'):
+    random = numpy.random.RandomState(seed)
+    shape = (days, securities)
+    regime = numpy.cumsum(random.uniform(size=shape) < 1.0 / 20, axis=0)
+    drift = random.normal(0, 0.01, size=shape)[regime, numpy.arange(securities)]
+    close = random.uniform(10, 200, size=securities) * numpy.exp(numpy.cumsum(drift + random.normal(0, 0.01, size=shape), axis=0))
+    open = numpy.vstack((close[:1], close[:-1])) * numpy.exp(random.normal(0, 0.003, size=shape))
+    high = numpy.maximum(open, close) * (1 + numpy.abs(random.normal(0, 0.005, size=shape)))
+    low = numpy.minimum(open, close) * (1 - numpy.abs(random.normal(0, 0.005, size=shape)))
+    volume = numpy.exp(random.normal(13, 1, size=securities)) * random.lognormal(0, 0.3, size=shape)
+    values = numpy.array([open, high, low, close, volume])
+
+    listed = numpy.flatnonzero(random.uniform(size=securities) < churn)
+    for s in listed:
+        first, last = random.randint(0, days // 2 + 1), random.randint(days // 2, days + 1)
+        values[:, :first, s] = numpy.nan
+        values[:, last:, s] = numpy.nan
+    return array_bars(values, start_date)
+
+class Position:
+    def __init__(self, amount, price):
+        self.amount = amount
+        self.cost_basis = price
+        self.last_sale_price = price
+
+class Portfolio:
+    def __init__(self, capital):
+        self.starting_cash = capital
+        self.cash = capital
+        self.positions = {}
+
+    @property
+    def positions_value(self):
+        return sum(position.amount * position.last_sale_price for position in self.positions.values())
+
+    @property
+    def portfolio_value(self):
+        return self.cash + self.positions_value
+
+class Context:
+    def __init__(self, capital):
+        self.portfolio = Portfolio(capital)
+
+# The current bar of a security, what data[security] is on the platform
+class BarData:
+    def __init__(self, open, high, low, close, volume):
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close_price = self.close = self.price = close
+        self.volume = volume
+
+class Log:
+    def __init__(self, echo=False):
+        self.echo = echo
+        self.lines = 0
+        self.date = None
+
+    def write(self, level, message):
+        self.lines += 1
+        if self.echo:
+            sys.stderr.write("%s %s: %s\n" % (self.date, level, message))
+
+    def debug(self, message):
+        self.write('DEBUG', message)
+
+    def info(self, message):
+        self.write('INFO', message)
+
+    def warn(self, message):
+        self.write('WARN', message)
+
+    def error(self, message):
+        self.write('ERROR', message)
+
+# What universe.DollarVolumeUniverse(floor, ceiling) stands for, recorded but not applied
+class DollarVolumeUniverse:
+    def __init__(self, floor_percentile, ceiling_percentile):
+        self.floor_percentile = floor_percentile
+        self.ceiling_percentile = ceiling_percentile
+
+    def __repr__(self):
+        return "DollarVolumeUniverse(%g, %g)" % (self.floor_percentile, self.ceiling_percentile)
+
+# The platform's `universe` module
+class Universe:
+    DollarVolumeUniverse = DollarVolumeUniverse
+
+# Adds up the time spent in the wrapped functions. Calls made from inside another wrapped
+# function (segmented() from segmented_batch(), say) are part of the outer call and don't count
+# twice
+class Timer:
+    def __init__(self):
+        self.time = 0.0
+        self.calls = 0
+        self.depth = 0
+
+    def wrap(self, function):
+        def timed(*args, **kwargs):
+            if self.depth > 0:
+                return function(*args, **kwargs)
+            self.depth += 1
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.time += time.time() - start
+                self.calls += 1
+                self.depth -= 1
+        # pickling finds functions by name, and the pool of parallel_segments() pickles some
+        timed.__name__ = function.__name__
+        timed.__module__ = function.__module__
+        timed.__doc__ = function.__doc__
+        return timed
+
+    def reset(self):
+        self.time = 0.0
+        self.calls = 0
+
+# Runs a strategy over the bars, a day at a time, standing in for the platform
+class Replay:
+    def __init__(self, filename, bars, capital=1e6, universe_size=None, rerank=63, echo=False):
+        self.bars = bars
+        self.universe_size = universe_size
+        self.rerank = rerank
+        self.day = 0
+        self.universe = []
+        self.ranking = None
+        self.requested_universe = None
+        self.orders = 0
+        self.recorded = {}
+        self.log = Log(echo)
+        self.segmenting = Timer()
+        self.fetching = Timer()
+        self.context = Context(capital)
+
+        # every field as one (days, securities) array, the columns in the order of bars.securities
+        self.values = dict((field, bars.frames[field].values) for field in FIELDS)
+        self.columns = dict((security, n) for n, security in enumerate(bars.securities))
+        self.module = self.load(filename)
+
+    # Executes the strategy's file as a module of its own, with the stand-ins as globals
+    def load(self, filename):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        module = types.ModuleType(name)
+        module.__file__ = filename
+        namespace = module.__dict__
+        namespace.update(self.platform())
+        # registered before it runs, so pool workers can unpickle its functions
+        sys.modules[name] = module
+        with open(filename) as f:
+            code = compile(f.read(), filename, 'exec')
+        exec(code, namespace)
+
+        for attribute, value in list(namespace.items()):
+            if isinstance(value, types.FunctionType) and value.__module__ == name:
+                if attribute.startswith(SEGMENTER_PREFIX) or attribute in SEGMENTER_HELPERS:
+                    namespace[attribute] = self.segmenting.wrap(value)
+        return module
+
+    # The platform functions and objects a strategy can use without importing them
+    def platform(self):
+        return {
+            'history': self.fetching.wrap(self.history),
+            'set_universe': self.set_universe,
+            'universe': Universe,
+            'order': self.order,
+            'order_target': self.order_target,
+            'order_percent': self.order_percent,
+            'order_target_percent': self.order_target_percent,
+            'order_value': self.order_value,
+            'order_target_value': self.order_target_value,
+            'get_open_orders': self.get_open_orders,
+            'record': self.record,
+            'log': self.log,
+        }
+
+    def set_universe(self, universe):
+        self.requested_universe = universe
+
+    # The last bar_count days up to and including today of every security in the universe
+    def history(self, bar_count, frequency, field):
+        if frequency != '1d':
+            raise ValueError("the replay only has daily bars, not %r" % frequency)
+        values = self.values['close' if field == 'price' else field]
+        first = max(self.day + 1 - bar_count, 0)
+        columns = [self.columns[security] for security in self.universe]
+        return pandas.DataFrame(values[first:self.day + 1, columns], index=self.bars.dates[first:self.day + 1], columns=self.universe)
+
+    def price(self, security):
+        return self.values['close'][self.day, self.columns[security]]
+
+    # Fills an order for the whole difference at today's close
+    def fill(self, security, amount):
+        amount = int(amount)
+        positions = self.context.portfolio.positions
+        position = positions.get(security)
+        held = position.amount if position is not None else 0
+        self.orders += 1
+        if amount == held:
+            return
+        price = self.price(security)
+        if numpy.isnan(price):
+            raise ValueError("%s doesn't trade on %s" % (security, self.bars.dates[self.day].date()))
+        self.context.portfolio.cash -= (amount - held) * price
+        if amount == 0:
+            del positions[security]
+        elif position is None:
+            positions[security] = Position(amount, price)
+        else:
+            if abs(amount) > abs(held) and amount * held > 0:
+                position.cost_basis = (position.cost_basis * held + price * (amount - held)) / amount
+            elif amount * held < 0:
+                position.cost_basis = price
+            position.amount = amount
+            position.last_sale_price = price
+
+    def held(self, security):
+        position = self.context.portfolio.positions.get(security)
+        return position.amount if position is not None else 0
+
+    def order(self, security, amount):
+        self.fill(security, self.held(security) + amount)
+
+    def order_target(self, security, amount):
+        self.fill(security, amount)
+
+    def order_value(self, security, value):
+        self.order(security, value / self.price(security))
+
+    def order_target_value(self, security, value):
+        self.fill(security, value / self.price(security))
+
+    def order_percent(self, security, percent):
+        self.order_value(security, percent * self.context.portfolio.portfolio_value)
+
+    def order_target_percent(self, security, percent):
+        self.order_target_value(security, percent * self.context.portfolio.portfolio_value)
+
+    def get_open_orders(self, security=None):
+        return [] if security is not None else {}
+
+    def record(self, **values):
+        self.recorded.update(values)
+
+    # Ranks the securities by their dollar volume over the last `lookback` days, the days they
+    # didn't trade counting as none. Without volumes they keep the order they were loaded in
+    def rank(self, lookback):
+        first = max(self.day + 1 - lookback, 0)
+        dollars = self.values['close'][first:self.day + 1] * self.values['volume'][first:self.day + 1]
+        total = numpy.where(numpy.isnan(dollars), 0.0, dollars).sum(axis=0)
+        return numpy.argsort(-total, kind='mergesort')
+
+    # The universe of today: the top securities by dollar volume with a close every day of the lookback
+    def select_universe(self, lookback):
+        if self.ranking is None or self.day % self.rerank == 0:
+            self.ranking = self.rank(lookback)
+        first = max(self.day + 1 - lookback, 0)
+        trading = ~numpy.isnan(self.values['close'][first:self.day + 1]).any(axis=0)
+        ranked = self.ranking[trading[self.ranking]][:self.universe_size]
+        self.universe = [self.bars.securities[s] for s in numpy.sort(ranked)]
+
+    def today(self):
+        bar = dict((field, self.values[field][self.day]) for field in FIELDS)
+        data = {}
+        for security in self.universe:
+            s = self.columns[security]
+            data[security] = BarData(bar['open'][s], bar['high'][s], bar['low'][s], bar['close'][s], bar['volume'][s])
+        return data
+
+    # Brings held positions to today's prices, keeping the last one for days they don't trade
+    def mark(self):
+        for security, position in self.context.portfolio.positions.items():
+            price = self.price(security)
+            if not numpy.isnan(price):
+                position.last_sale_price = price
+
+    def initialize(self, settings=()):
+        self.module.initialize(self.context)
+        # evaluated in the strategy's namespace, so its classes and the context can be used
+        namespace = dict(self.module.__dict__, context=self.context)
+        for name, expression in settings:
+            setattr(self.context, name, eval(expression, namespace))
+
+    # Replays every day from `start` (the first day with a whole lookback by default) and yields
+    # the measurements of each one
+    def run(self, start=None, trace_memory=False):
+        lookback = getattr(self.context, 'lookback', 1)
+        start = lookback - 1 if start is None else start
+        for day in range(start, len(self.bars)):
+            self.day = day
+            self.log.date = self.bars.dates[day].date()
+            self.select_universe(lookback)
+            self.mark()
+            data = self.today()
+
+            orders, lines = self.orders, self.log.lines
+            self.segmenting.reset()
+            self.fetching.reset()
+            self.recorded = {}
+            if trace_memory:
+                tracemalloc.start()
+            begin = time.time()
+            self.module.handle_data(self.context, data)
+            wall = time.time() - begin
+            peak = None
+            if trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            yield {
+                'day': day, 'date': str(self.bars.dates[day].date()), 'universe': len(self.universe),
+                'wall': wall, 'segmented_time': self.segmenting.time, 'segmented_calls': self.segmenting.calls,
+                'history_time': self.fetching.time, 'orders': self.orders - orders, 'log_lines': self.log.lines - lines,
+                'rss_bytes': resident_bytes(), 'peak_bytes': peak,
+                'positions': len(self.context.portfolio.positions), 'portfolio_value': self.context.portfolio.portfolio_value,
+                'recorded': self.recorded,
+            }
+
+    # The platform never stops a strategy, so it has no hook to free what it holds. Closes the
+    # worker pool segmented.py keeps in context.pool, which otherwise breaks the interpreter's exit
+    def finish(self):
+        pool = getattr(self.context, 'pool', None)
+        if pool is not None:
+            pool.close()
+
+# Memory in use by the process right now, where /proc tells
+def resident_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+def percentile(values, q):
+    return float(numpy.percentile(values, q)) if len(values) else float('nan')
+
+def summary(records, capital):
+    if not records:
+        return "no days to replay"
+    wall = numpy.array([record['wall'] for record in records])
+    segmenting = sum(record['segmented_time'] for record in records)
+    fetching = sum(record['history_time'] for record in records)
+    orders = numpy.array([record['orders'] for record in records])
+    rss = [record['rss_bytes'] for record in records if record['rss_bytes'] is not None]
+    peaks = [record['peak_bytes'] for record in records if record['peak_bytes'] is not None]
+    lines = [
+        "%d days, %d securities a day on average, %.2fs in handle_data" % (len(records), numpy.mean([record['universe'] for record in records]), wall.sum()),
+        "per day: mean %.1fms  p50 %.1fms  p95 %.1fms  max %.1fms" % (1000 * wall.mean(), 1000 * percentile(wall, 50), 1000 * percentile(wall, 95), 1000 * wall.max()),
+        "segmented() %.2fs (%.0f%%), history() %.2fs (%.0f%%)" % (segmenting, 100 * segmenting / max(wall.sum(), 1e-12), fetching, 100 * fetching / max(wall.sum(), 1e-12)),
+        "orders: %d in all, %.1f a day, at most %d" % (orders.sum(), orders.mean(), orders.max()),
+    ]
+    if rss:
+        lines.append("memory: %.1fMB resident at most" % (max(rss) / 1e6) + ("" if not peaks else ", %.1fMB allocated in a day at most" % (max(peaks) / 1e6)))
+    lines.append("portfolio: %.2f, %+.2f%%" % (records[-1]['portfolio_value'], 100 * (records[-1]['portfolio_value'] / capital - 1)))
+    return "\n".join(lines)
+
+def setting(text):
+    name, separator, expression = text.partition('=')
+    if not separator or not name.strip():
+        raise argparse.ArgumentTypeError("expected NAME=EXPRESSION, got %r" % text)
+    return name.strip(), expression
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a strategy offline over daily bars and time every bar")
+    parser.add_argument('strategy', help="the strategy's file, e.g. segmented.py")
+    parser.add_argument('--data', help=".csv or .npy file of daily bars, synthetic bars when not given")
+    parser.add_argument('--securities', type=int, default=500, help="synthetic securities")
+    parser.add_argument('--days', type=int, default=300, help="synthetic days")
+    parser.add_argument('--churn', type=float, default=0.0, help="fraction of the synthetic securities that only trade for part of the days")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start-date', default='2015-01-02', help="first day of synthetic and .npy bars")
+    parser.add_argument('--universe', type=int, help="securities in the universe each day, all of them by default")
+    parser.add_argument('--rerank', type=int, default=63, help="days between rankings of the universe by dollar volume")
+    parser.add_argument('--start', type=int, help="first day to replay, the first with a whole lookback by default")
+    parser.add_argument('--capital', type=float, default=1e6)
+    parser.add_argument('--set', type=setting, action='append', default=[], metavar='NAME=EXPRESSION',
+                        help="set context.NAME after initialize(), evaluated in the strategy's namespace")
+    parser.add_argument('--trace-memory', action='store_true', help="also measure the peak allocations of every day (slower)")
+    parser.add_argument('--log', action='store_true', help="print the strategy's log to stderr")
+    parser.add_argument('--output', help="JSON Lines file to write the measurements of every day to")
+    args = parser.parse_args()
+
+    if args.trace_memory and tracemalloc is None:
+        parser.error("--trace-memory needs tracemalloc (Python 3)")
+    try:
+        bars = load_bars(args.data, args.start_date) if args.data else synthetic_bars(args.securities, args.days, args.seed, args.churn, args.start_date)
+    except (IOError, OSError, ValueError, KeyError) as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
+    replay = Replay(args.strategy, bars, args.capital, args.universe, args.rerank, args.log)
+    replay.initialize(args.set)
+    records = []
+    output = open(args.output, 'w') if args.output else None
+    try:
+        for record in replay.run(args.start, args.trace_memory):
+            records.append(record)
+            if output is not None:
+                output.write(json.dumps(record, sort_keys=True) + "\n")
+    finally:
+        replay.finish()
+        if output is not None:
+            output.close()
+    print(summary(records, args.capital))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+# Command-line front end of segmented(). Loads whole files of series in one go and prints the
+# optimal segments of each one in the same format as segmented.cpp.
+#
+#   python segment_cli.py < test-1.txt               # the reference input format on stdin
+#   python segment_cli.py test-1.txt test-2.txt      # any number of files, each with any number of series
+#   python segment_cli.py prices.npy --cost 10       # one series per row, memory mapped
+#   python segment_cli.py prices.f8 --length 390 --cost 10 20 30
+#   python segment_cli.py dumps/ 'more/*.npy' --cost 10 --output segments.jsonl --jobs 8
+#
+# Text files hold one or more series separated by blank lines, each one a line with its cost
+# followed by a line of "x y" per point (ints or floats), like the test-*.txt files. .npy files and raw little-endian
+# float64 files (.f8, .bin, .raw) hold y values only, with x = 0..N-1: a 1-D array is one series
+# and each row of a 2-D array (or each --length values of a raw file) is another. Their costs
+# come from --cost, either one for every series or one per series.
+#
+# With --output the files (directories and glob patterns are expanded) are segmented in batch
+# over a pool of --jobs worker processes, and the segments of every file are written along with
+# how long it took to load and to segment, either as JSON Lines (one record per file) or, for
+# a .npz output, as columns of all the segments plus an index of the series and the files
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import numpy
+
+import segmented
+
+BINARY_EXTENSIONS = ('.f8', '.bin', '.raw')
+
+# Bytes of error terms a single segmented_batch() call may work on. It holds an (S, N+1, N+1)
+# error matrix (an (S, N+1, max_length+1) band with --max-length) and temporaries of the same
+# size, so the rows of a file go through it in chunks that stay under this
+BATCH_BYTES = 32 * 2**20
+
+# A run of non-blank lines, one series of a text file
+SERIES_BLOCK = re.compile(r'(?:^[ \t]*\S[^\n]*(?:\n|$))+', re.M)
+
+# Loads every series in a file as a list of (cost, x, y). Binary files are memory mapped and
+# their rows are views of the map, so nothing is read until a series is segmented
+def load_series(filename, cost=None, length=None):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.npy':
+        return binary_series(numpy.load(filename, mmap_mode='r'), cost, filename)
+    if extension in BINARY_EXTENSIONS:
+        values = numpy.memmap(filename, dtype='<f8', mode='r') if os.path.getsize(filename) > 0 else numpy.zeros(0)
+        if length is not None:
+            if len(values) % length != 0:
+                raise ValueError("%s: %d values don't split into series of %d" % (filename, len(values), length))
+            values = values.reshape(-1, length)
+        return binary_series(values, cost, filename)
+    with open(filename) as f:
+        try:
+            text = f.read()
+        except UnicodeDecodeError as e:
+            raise ValueError("%s: not a text file of series (%s)" % (filename, e))
+    return parse_series(text, filename)
+
+def binary_series(values, cost, name):
+    if values.ndim == 1:
+        values = values[numpy.newaxis, :]
+    if values.ndim != 2:
+        raise ValueError("%s: expected a 1-D or 2-D array, got %d dimensions" % (name, values.ndim))
+    S, N = values.shape
+    costs = costs_for(cost, S, name)
+    x = numpy.arange(N, dtype=float)
+    return [(costs[s], x, values[s]) for s in range(S)]
+
+def costs_for(cost, S, name):
+    if cost is None:
+        raise ValueError("%s: binary series need a --cost" % name)
+    if numpy.ndim(cost) == 0:
+        return [float(cost)] * S
+    if len(cost) == 1:
+        return [float(cost[0])] * S
+    if len(cost) != S:
+        raise ValueError("%s: got %d costs for %d series" % (name, len(cost), S))
+    return [float(c) for c in cost]
+
+# Parses text in the reference format, any number of series separated by blank lines. The
+# points of each series are converted in one numpy call rather than line by line, and only when
+# they don't come out as pairs are the lines looked at one by one to report the bad one
+def parse_series(text, name='<stdin>'):
+    returns = []
+    for block in SERIES_BLOCK.finditer(text):
+        first = text.count('\n', 0, block.start()) + 1
+        lines = block.group().rstrip('\n').split('\n')
+        if len(lines[0].split()) != 1:
+            raise ValueError("%s: line %d: expected the cost of a series, got %r" % (name, first, lines[0].strip()))
+        try:
+            cost = float(lines[0])
+            values = numpy.array(" ".join(lines[1:]).split(), dtype=float)
+        except ValueError as e:
+            raise ValueError("%s: malformed series starting on line %d (%s)" % (name, first, e))
+        if len(values) != 2 * (len(lines) - 1):
+            for n, line in enumerate(lines[1:]):
+                if len(line.split()) != 2:
+                    raise ValueError("%s: line %d: expected a point \"x y\", got %r" % (name, first + n + 1, line.strip()))
+        values = values.reshape(-1, 2)
+        returns.append((cost, values[:, 0], values[:, 1]))
+    return returns
+
+# Ints print like the C++ reference does, anything else (nan and inf too) as compactly as possible
+def number(value):
+    return "%d" % value if numpy.isfinite(value) and value == int(value) else "%g" % value
+
+def report(x, segments):
+    lines = ["Got %d points" % len(x), "Cost of the optimal solution : %f" % segments.cost, "", "An optimal solution :"]
+    for segment in segments:
+        lines.append("Segment (y = %f * x + %f) from point #%d: %s %s to point #%d: %s %s with square error %f." % (
+            segment.slope, segment.intercept, segment.start+1, number(segment.p1.x), number(segment.p1.y),
+            segment.end+1, number(segment.p2.x), number(segment.p2.y), segment.sqerr))
+    return "\n".join(lines)
+
+# Every file of each directory (sorted) and every match of each glob pattern, in order
+def expand_inputs(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if os.path.isfile(os.path.join(path, name))))
+        elif os.path.exists(path):
+            files.append(path)
+        else:
+            matches = sorted(glob.glob(path))
+            # a path that matches nothing is kept, so it gets reported as missing
+            files.extend(matches if matches else [path])
+    return files
+
+# Loads and segments every series of one file, in a worker process. The points are dropped
+# from the results, they only need to go back to the parent as columns
+def segment_file(task):
+    filename, cost, length, options = task
+    record = {'file': filename}
+    start = time.time()
+    try:
+        series = load_series(filename, cost, length)
+    except (IOError, OSError, ValueError) as e:
+        record['error'] = str(e)
+        return record
+    loaded = time.time()
+
+    # the rows of a binary file share x, so with one cost they go through batches of as many
+    # rows as BATCH_BYTES allows
+    rows = 1
+    if len(series) > 1 and not options.get('pruned') and len(set((C, id(x)) for C, x, y in series)) == 1:
+        C, x = series[0][:2]
+        rows = batch_rows(len(x), options.get('max_length'))
+    if rows > 1:
+        all_segments = []
+        for first in range(0, len(series), rows):
+            chunk = numpy.array([y for C, x, y in series[first:first+rows]])
+            all_segments.extend(segmented.segmented_batch(chunk, C, x=x, max_length=options.get('max_length')))
+    else:
+        all_segments = [segmented.segmented((x, y), C, **options) for C, x, y in series]
+
+    results = []
+    for (C, x, y), segments in zip(series, all_segments):
+        segments.x = segments.y = None
+        results.append((C, len(x), segments))
+    record['series'] = results
+    record['load_time'] = loaded - start
+    record['segment_time'] = time.time() - loaded
+    return record
+
+# Number of series of N points whose error terms fit in BATCH_BYTES, at least 1
+def batch_rows(N, max_length=None):
+    width = N + 1 if max_length is None else min(max_length, N) + 1
+    return max(1, BATCH_BYTES // (8 * (N + 1) * width))
+
+def json_record(record):
+    if 'error' in record:
+        return record
+    series = []
+    for C, N, segments in record['series']:
+        series.append({
+            'cost': C, 'points': N, 'opt_cost': segments.cost,
+            'start': segments.start.tolist(), 'end': segments.end.tolist(),
+            'slope': segments.slope.tolist(), 'intercept': segments.intercept.tolist(), 'sqerr': segments.sqerr.tolist(),
+        })
+    return dict(record, series=series)
+
+# Writes the segments of every series as five columns, series_* arrays with the rows of each
+# series (series_offset and series_count) and file_* arrays with the timings and errors of
+# each file. series_file is the position of a series' file in file_name
+def write_columnar(filename, records):
+    columns = dict((name, []) for name in ('start', 'end', 'slope', 'intercept', 'sqerr'))
+    series = dict((name, []) for name in ('file', 'cost', 'points', 'opt_cost', 'offset', 'count'))
+    offset = 0
+    for n, record in enumerate(records):
+        for C, N, segments in record.get('series', []):
+            for name in columns:
+                columns[name].append(getattr(segments, name))
+            for name, value in (('file', n), ('cost', C), ('points', N), ('opt_cost', segments.cost), ('offset', offset), ('count', len(segments))):
+                series[name].append(value)
+            offset += len(segments)
+
+    arrays = {}
+    for name, dtype in (('start', int), ('end', int), ('slope', float), ('intercept', float), ('sqerr', float)):
+        arrays[name] = numpy.concatenate(columns[name]).astype(dtype) if columns[name] else numpy.zeros(0, dtype=dtype)
+    for name, dtype in (('file', int), ('cost', float), ('points', int), ('opt_cost', float), ('offset', int), ('count', int)):
+        arrays['series_' + name] = numpy.array(series[name], dtype=dtype)
+    arrays['file_name'] = numpy.array([record['file'] for record in records], dtype=str)
+    arrays['file_load_time'] = numpy.array([record.get('load_time', numpy.nan) for record in records])
+    arrays['file_segment_time'] = numpy.array([record.get('segment_time', numpy.nan) for record in records])
+    arrays['file_error'] = numpy.array([record.get('error', '') for record in records], dtype=str)
+    numpy.savez(filename, **arrays)
+
+# Segments every file on a pool of `jobs` processes (or in this one for a single job), writing
+# the records as they come back in the order of the files. Returns the number of failed files
+def run_batch(files, output, jobs, cost=None, length=None, options={}):
+    tasks = [(filename, cost, length, options) for filename in files]
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    results = pool.imap(segment_file, tasks) if pool is not None else (segment_file(task) for task in tasks)
+
+    columnar = output.endswith('.npz')
+    records = []
+    errors = series = segments = 0
+    start = time.time()
+    try:
+        with open(os.devnull if columnar else output, 'w') as f:
+            for record in results:
+                if 'error' in record:
+                    errors += 1
+                    sys.stderr.write("%s\n" % record['error'])
+                else:
+                    series += len(record['series'])
+                    segments += sum(len(s) for C, N, s in record['series'])
+                if columnar:
+                    records.append(record)
+                else:
+                    f.write(json.dumps(json_record(record), sort_keys=True) + "\n")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if columnar:
+        write_columnar(output, records)
+
+    sys.stderr.write("%d files (%d failed), %d series, %d segments in %.2fs\n" % (len(files), errors, series, segments, time.time() - start))
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment series with segmented least squares")
+    parser.add_argument('files', nargs='*', help="text, .npy or raw float64 files (or, with --output, directories and glob patterns), stdin when none are given")
+    parser.add_argument('--cost', type=float, nargs='+', help="cost of the series in binary files, one for all or one per series")
+    parser.add_argument('--length', type=int, help="points per series in raw float64 files, one series when not given")
+    parser.add_argument('--pruned', action='store_true', help="use the pruned recurrence, for long series")
+    parser.add_argument('--max-length', type=int, help="longest segment allowed, in points")
+    parser.add_argument('--output', help="segment the files in batch and write the results to this .jsonl or .npz file")
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help="worker processes for --output, all cores by default")
+    args = parser.parse_args()
+
+    if args.output:
+        if not args.files:
+            parser.error("--output needs files to segment")
+        options = {'pruned': args.pruned, 'max_length': args.max_length}
+        if run_batch(expand_inputs(args.files), args.output, args.jobs, args.cost, args.length, options) > 0:
+            sys.exit(1)
+        return
+
+    try:
+        if args.files:
+            series = [s for filename in args.files for s in load_series(filename, args.cost, args.length)]
+        else:
+            series = parse_series(sys.stdin.read())
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
+    for n, (C, x, y) in enumerate(series):
+        if n > 0:
+            print("")
+        print(report(x, segmented.segmented((x, y), C, pruned=args.pruned, max_length=args.max_length)))
+
+if __name__ == '__main__':
+    main()
@@ -26,58 +26,352 @@ def initialize(context):
     # The cost of creating a new segment in segmented least squares
     context.segment_cost = 4
 
+    # The longest segment (in bars) segmented least squares may fit, None for no limit. Only the
+    # recent trend matters, so capping it cuts the work from O(lookback^2) to O(lookback * cap).
+    # The rolling segmenters below always fit without a cap
+    context.max_segment_length = None
+
     context.error_threshold = 2
 
-def handle_data(context, data):
-    high_history = history(bar_count=context.lookback, frequency="1d", field='high')
-    low_history = history(bar_count=context.lookback, frequency="1d", field='low')
-    buys = []
-    # For each stock lets compute the slope of mins and the slope of maxes
-    # O(s)
-    for security in data:
+    # Keep a RollingBatchSegmenter per field that only computes the error terms of the newest bar
+    # of every window, instead of re-segmenting every window of the universe from scratch each bar
+    context.rolling = False
 
-        # Calculate the relative slopes (They aren't the exact slopes but they are accurate relative to each other)
-        points_high = convert_to_points(high_history[security])
-        points_low = convert_to_points(low_history[security])
-        
-        segments_high = segmented(points_high, context.segment_cost)
-        segments_low = segmented(points_low, context.segment_cost)
-        
-        if angle_between_slopes(segments_high[-1].slope, segments_low[-1].slope) < context.flag_tolerance_degrees:
-            avg_slope = np.mean([segments_high[-1].slope,segments_low[-1].slope])
-            if avg_slope > context.min_positive_slope:
+    # How far (in price) a new bar may be from the line of the last segment and still just
+    # extend it without re-segmenting. None always re-segments exactly
+    context.rolling_tolerance = None
+    context.segmenters = {}
 
-                if segments_high[-1].sqerr < context.error_threshold and segments_high[-1].sqerr < context.error_threshold:
-                    buys.append(security)
+    # Number of worker processes the securities are spread over each bar (1 segments everything
+    # in this process). The history windows reach the workers through shared memory
+    context.workers = 1
+    context.pool = None
 
+    # A SegmentationCache to memoize the batched segmentation of windows that were already
+    # segmented with the same cost, e.g. SegmentationCache(maxsize=100000) for repeated runs
+    context.segment_cache = None
 
-                    print("BUYING %s, S=%f, E_h=%f, E_l=%f" % (security, avg_slope, segments_high[-1].sqerr, segments_low[-1].sqerr))
-                else:
-                    nothing=1
-                    log.warn("REJECTED %s because error is too high" % security)
-            else:
-                nothing=1
+    # A SegmentStore directory to read the segmentations of earlier runs from (and add new ones
+    # to), for offline backtest replays. Windows are keyed by the date of their last bar
+    context.segment_store = None
+
+    # A profiler for the plain batch path, e.g. SegmentationProfile() to log where the time goes
+    # with log.info(context.profiler.summary())
+    context.profiler = None
+
+    # Segment the highs and the lows of a security together so they share their breakpoints
+    # and the flag compares lines over the same bars (see segmented_joint)
+    context.joint = False
+
+    # Every bar the decisions are counted by reason and logged as one summary line (see
+    # DecisionTelemetry). verbose_decisions logs a line per security instead, for debugging
+    context.telemetry = DecisionTelemetry()
+    context.verbose_decisions = False
+
+    # Positions already within this fraction of the portfolio of their target aren't traded
+    context.rebalance_tolerance = 0.005
+
+    # A HistoryCache keeps the windows of every security between bars and only fetches the
+    # newest bar each day, e.g. HistoryCache(context.lookback). None fetches whole windows
+    context.history_cache = None
+
+def handle_data(context, data):
+    # The (securities, lookback) windows of highs and lows, one row per security
+    securities = list(data)
+    if context.history_cache is not None:
+        date, high_windows, low_windows = context.history_cache.update(securities, history)
+    else:
+        high_history = history(bar_count=context.lookback, frequency="1d", field='high')
+        low_history = history(bar_count=context.lookback, frequency="1d", field='low')
+        date = high_history.index[-1]
+        high_windows = high_history[securities].values.T
+        low_windows = low_history[securities].values.T
+
+    if context.rolling:
+        all_segments_high = rolling_segments(context, securities, high_windows, 'high')
+        all_segments_low = rolling_segments(context, securities, low_windows, 'low')
+    elif context.workers > 1:
+        all_segments_high, all_segments_low = parallel_segments(context, securities, high_windows, low_windows)
+    elif context.segment_store is not None:
+        all_segments_high = stored_segments(context, securities, high_windows, date, 'high')
+        all_segments_low = stored_segments(context, securities, low_windows, date, 'low')
+    elif context.joint:
+        windows = numpy.array([high_windows, low_windows]).transpose(1, 0, 2)
+        joint = segmented_joint(windows, context.segment_cost, max_length=context.max_segment_length)
+        # two lists, empty as well when the universe is
+        all_segments_high = [segments[0] for segments in joint]
+        all_segments_low = [segments[1] for segments in joint]
+    elif context.segment_cache is not None:
+        all_segments_high = context.segment_cache.segmented_batch(high_windows, context.segment_cost, max_length=context.max_segment_length)
+        all_segments_low = context.segment_cache.segmented_batch(low_windows, context.segment_cost, max_length=context.max_segment_length)
+    else:
+        # Segment the highs and the lows of every security in one pass each
+        all_segments_high = segmented_batch(high_windows, context.segment_cost, max_length=context.max_segment_length, profiler=context.profiler)
+        all_segments_low = segmented_batch(low_windows, context.segment_cost, max_length=context.max_segment_length, profiler=context.profiler)
+
+    # For each stock lets compare the slope of mins and the slope of maxes, all at once
+    # O(s)
+    slopes_high = np.array([segments.slope[-1] for segments in all_segments_high])
+    slopes_low = np.array([segments.slope[-1] for segments in all_segments_low])
+    errors_high = np.array([segments.sqerr[-1] for segments in all_segments_high])
+    errors_low = np.array([segments.sqerr[-1] for segments in all_segments_low])
+    reasons, angles, avg_slopes = screen_flags(context, slopes_high, slopes_low, errors_high)
+    buys = [securities[n] for n in np.flatnonzero(reasons == FLAG_BUY)]
+
+    if context.verbose_decisions:
+        for n, security in enumerate(securities):
+            if reasons[n] == FLAG_BUY:
+                print("BUYING %s, S=%f, E_h=%f, E_l=%f" % (security, avg_slopes[n], errors_high[n], errors_low[n]))
+            elif reasons[n] == REJECT_ERROR:
+                log.warn("REJECTED %s because error is too high" % security)
+            elif reasons[n] == REJECT_NOT_POSITIVE:
                 log.warn("REJECTED %s not positive enough... threshold is %f" % (security, context.min_positive_slope))
-        else:
-            nothing=1
-            print("REJECTED %s... not a flag" % security)
+            else:
+                print("REJECTED %s... not a flag" % security)
+    else:
+        context.telemetry.record(securities, reasons, angles, avg_slopes, errors_high)
+        log.info(context.telemetry.summary())
                 
     log.info("================ END OF DAY ================")
     
     
-    # If we have any buys then determine the percentage of our portfolio
-    if len(buys) > 0:
-        percent_per_sec = 1 / len(buys)
-    else: 
-        percent_per_sec = 0
-        
-    for security in data:
-        if security in buys:
-            # Invest percent_per_sec percent of our portfolio in the security
-            order_target_percent(security, percent_per_sec)
-        else:
-            # if it isn't in the buys list, then sell it
+    # If we have any buys then split the portfolio evenly between them, everything else is sold
+    percent_per_sec = 1.0 / len(buys) if buys else 0
+    targets = dict((security, percent_per_sec) for security in buys)
+
+    # Only order what actually changes our exposure
+    for security, percent in plan_rebalance(context, securities, targets, context.rebalance_tolerance):
+        if percent == 0:
             order_target(security, 0)
+        else:
+            order_target_percent(security, percent)
+
+# Works out the orders that take the portfolio to the target weights (security -> fraction of
+# the portfolio, anything else in securities goes to 0) and returns them as (security, target)
+# pairs. Securities we hold none of that should stay at 0, and positions within tolerance of
+# their target, get no order. Neither do securities with open orders: order_target* doesn't
+# count open orders, so ordering again before they fill would overshoot. O(s)
+def plan_rebalance(context, securities, targets, tolerance=0):
+    portfolio = context.portfolio
+    positions = portfolio.positions
+    open_orders = get_open_orders()
+    value = portfolio.portfolio_value
+
+    orders = []
+    for security in securities:
+        if security in open_orders:
+            continue
+        target = targets.get(security, 0)
+        position = positions.get(security)
+        amount = position.amount if position is not None else 0
+        if amount == 0:
+            if target != 0:
+                orders.append((security, target))
+        elif target == 0:
+            orders.append((security, 0))
+        elif value <= 0 or abs(amount * position.last_sale_price / value - target) > tolerance:
+            orders.append((security, target))
+    return orders
+
+# Segments the windows of every security with the RollingBatchSegmenter of that field, which
+# picks up securities that just entered the universe and drops the ones that left
+def rolling_segments(context, securities, windows, field):
+    segmenter = context.segmenters.get(field)
+    if segmenter is None:
+        segmenter = context.segmenters[field] = RollingBatchSegmenter(context.segment_cost, context.lookback, context.rolling_tolerance)
+    return segmenter.segment(securities, windows)
+
+# Splits the securities into one contiguous chunk per worker and segments them on the pool.
+# Results come back in the order of securities, so buys and the log match a serial run
+def parallel_segments(context, securities, high_windows, low_windows):
+    windows = numpy.array([high_windows, low_windows])
+    if context.pool is None or context.pool.capacity < windows.size:
+        if context.pool is not None:
+            context.pool.close()
+        context.pool = SegmentationPool(context.workers, 2 * windows.size)
+
+    chunks = numpy.array_split(numpy.arange(len(securities)), context.workers)
+    tasks = [(chunk[0], chunk[-1] + 1) for chunk in chunks if len(chunk) > 0]
+    results = context.pool.map(windows, tasks, context.segment_cost, context.max_segment_length)
+
+    all_segments_high = []
+    all_segments_low = []
+    for segments_high, segments_low in results:
+        all_segments_high.extend(segments_high)
+        all_segments_low.extend(segments_low)
+
+    x = numpy.arange(windows.shape[2])
+    for segments, y in zip(all_segments_high + all_segments_low, list(high_windows) + list(low_windows)):
+        segments.x, segments.y = x, y
+    return all_segments_high, all_segments_low
+
+# Reads the segments of every security's window for this field, ending at date, from
+# context.segment_store and segments the windows it doesn't have yet in one batch, storing them
+# for the next run
+def stored_segments(context, securities, windows, date, field):
+    store = context.segment_store
+    length = windows.shape[1]
+    returns = [store.get(security, date, field, context.segment_cost, length, context.max_segment_length) for security in securities]
+
+    missed = [n for n in range(len(securities)) if returns[n] is None]
+    if missed:
+        for n, segments in zip(missed, segmented_batch(windows[missed], context.segment_cost, max_length=context.max_segment_length)):
+            store.put(securities[n], date, field, context.segment_cost, length, context.max_segment_length, segments)
+            returns[n] = segments
+        store.flush()
+    return returns
+
+# Keeps the last `lookback` bars of every field of every security in a ring buffer per field, one
+# row per security, so each day only the newest bar has to be fetched. Every value is written at
+# both k and k + lookback of a row twice as long as the window, which keeps the current window
+# one contiguous slice whatever the ring position, and all rows share the position, so the
+# windows of all securities are a single zero-copy (securities, lookback) view. The views are
+# overwritten by the next update. history is the platform's history() or anything that takes
+# the same arguments and returns a frame of dates by securities
+class HistoryCache:
+    def __init__(self, lookback, fields=('high', 'low')):
+        self.lookback = lookback
+        self.fields = fields
+        self.securities = []
+        self.buffers = dict((field, np.zeros((0, 2 * lookback))) for field in fields)
+        # the current window is buffers[field][:, position:position+lookback]
+        self.position = 0
+        self.date = None
+        self.fetches = {'bars': 0, 'full': 0}
+
+    # Brings the windows up to date for the given securities, in that order, and returns the
+    # date of the newest bar followed by the window of every field
+    def update(self, securities, history):
+        securities = list(securities)
+        latest = dict((field, history(bar_count=2, frequency="1d", field=field)) for field in self.fields)
+        dates = latest[self.fields[0]].index
+        self.fetches['bars'] += 1
+
+        if self.date is None or (dates[-1] != self.date and dates[0] != self.date):
+            # first call, or days were skipped: start over
+            self.refill(securities, history)
+        else:
+            if securities != self.securities:
+                self.select(securities, history)
+            if dates[-1] != self.date:
+                self.append(dict((field, latest[field][securities].values[-1]) for field in self.fields))
+                self.date = dates[-1]
+        return (self.date,) + tuple(self.window(field) for field in self.fields)
+
+    def window(self, field):
+        return self.buffers[field][:, self.position:self.position + self.lookback]
+
+    def refill(self, securities, history):
+        frames = dict((field, history(bar_count=self.lookback, frequency="1d", field=field)) for field in self.fields)
+        self.fetches['full'] += 1
+        self.securities = securities
+        self.position = 0
+        for field in self.fields:
+            self.buffers[field] = np.tile(frames[field][securities].values.T, 2)
+        self.date = frames[self.fields[0]].index[-1]
+
+    # Reorders the rows for a new universe, keeping the rows of securities we already have and
+    # fetching whole windows for the ones that just entered it
+    def select(self, securities, history):
+        rows = dict((security, n) for n, security in enumerate(self.securities))
+        known = [n for n, security in enumerate(securities) if security in rows]
+        entered = [n for n, security in enumerate(securities) if security not in rows]
+        for field in self.fields:
+            buffer = np.zeros((len(securities), 2 * self.lookback))
+            buffer[known] = self.buffers[field][[rows[securities[n]] for n in known]]
+            self.buffers[field] = buffer
+        self.securities = securities
+        if entered:
+            frames = dict((field, history(bar_count=self.lookback, frequency="1d", field=field)) for field in self.fields)
+            self.fetches['full'] += 1
+            names = [securities[n] for n in entered]
+            for field in self.fields:
+                # frames end at the newest bar, which isn't in the ring yet when a new one arrived
+                values = frames[field][names].values[-self.lookback:].T
+                if frames[field].index[-1] != self.date:
+                    values = np.hstack((values[:, :1], values[:, :-1]))
+                ring = np.roll(values, self.position, axis=1)
+                self.buffers[field][entered] = np.hstack((ring, ring))
+
+    # Pushes one new bar (field -> value of every security) into the rings
+    def append(self, bar):
+        k = self.position
+        for field in self.fields:
+            self.buffers[field][:, k] = bar[field]
+            self.buffers[field][:, k + self.lookback] = bar[field]
+        self.position = (k + 1) % self.lookback
+
+# Reason codes of screen_flags(), in the order the checks are made
+FLAG_BUY = 0
+REJECT_NOT_A_FLAG = 1
+REJECT_NOT_POSITIVE = 2
+REJECT_ERROR = 3
+
+# Screens every security at once from the slopes of the last segments of its highs and lows and
+# the square error of the last segment of its highs: the two lines have to be within
+# flag_tolerance_degrees of each other, their average slope above min_positive_slope and the
+# error below error_threshold. Returns the reason code of each security (FLAG_BUY for the ones
+# to buy), the angles and the average slopes. Each check is what a security has to pass, so a
+# NaN (a window with missing bars) fails it
+def screen_flags(context, slopes_high, slopes_low, errors_high):
+    angles = angles_between_slopes(slopes_high, slopes_low)
+    avg_slopes = (slopes_high + slopes_low) / 2
+    reasons = np.full(len(angles), FLAG_BUY, dtype=int)
+    reasons[~(errors_high < context.error_threshold)] = REJECT_ERROR
+    reasons[~(avg_slopes > context.min_positive_slope)] = REJECT_NOT_POSITIVE
+    reasons[~(angles < context.flag_tolerance_degrees)] = REJECT_NOT_A_FLAG
+    return reasons, angles, avg_slopes
+
+REASON_NAMES = ['buy', 'not a flag', 'not positive', 'error too high']
+
+# Counts the decisions of screen_flags() by reason, bar by bar and over the whole run, keeps
+# histograms of the angles, average slopes and square errors (of the highs, the ones
+# screen_flags() tests) seen so far and the first `samples` securities of every reason in the
+# last bar, so a bar costs one log line instead of one per security. Values outside the edges
+# count in the first or last bin; NaNs and infinities (windows with missing bars) aren't binned,
+# their securities only show up in the reason counts
+class DecisionTelemetry:
+    ANGLE_EDGES = np.linspace(0, 180, 37)
+    SLOPE_EDGES = np.linspace(-1, 1, 41)
+    SQERR_EDGES = np.array([0, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128])
+
+    def __init__(self, samples=3):
+        self.samples = samples
+        self.reset()
+
+    def reset(self):
+        self.bars = 0
+        self.counts = np.zeros(len(REASON_NAMES), dtype=int)
+        self.totals = np.zeros(len(REASON_NAMES), dtype=int)
+        self.examples = [[] for name in REASON_NAMES]
+        self.angles = np.zeros(len(self.ANGLE_EDGES) - 1, dtype=int)
+        self.slopes = np.zeros(len(self.SLOPE_EDGES) - 1, dtype=int)
+        self.errors = np.zeros(len(self.SQERR_EDGES) - 1, dtype=int)
+
+    def record(self, securities, reasons, angles, avg_slopes, errors):
+        self.bars += 1
+        self.counts = np.bincount(reasons, minlength=len(REASON_NAMES))
+        self.totals += self.counts
+        self.examples = [[securities[n] for n in np.flatnonzero(reasons == reason)[:self.samples]] for reason in range(len(REASON_NAMES))]
+        self.angles += histogram(angles, self.ANGLE_EDGES)
+        self.slopes += histogram(avg_slopes, self.SLOPE_EDGES)
+        self.errors += histogram(errors, self.SQERR_EDGES)
+
+    # e.g. "bar 12: 2 buy (SEC3, SEC9), 180 not a flag (SEC1, SEC2, SEC4), 0 not positive, ..."
+    def summary(self):
+        parts = []
+        for reason, name in enumerate(REASON_NAMES):
+            part = "%d %s" % (self.counts[reason], name)
+            if self.examples[reason]:
+                part += " (%s)" % ", ".join(str(security) for security in self.examples[reason])
+            parts.append(part)
+        return "bar %d: %s" % (self.bars, ", ".join(parts))
+
+# Counts of the finite values in each bin of edges, clamping the ones outside into the end bins
+def histogram(values, edges):
+    values = np.asarray(values)
+    bins = np.clip(np.searchsorted(edges, values[np.isfinite(values)], side='right') - 1, 0, len(edges) - 2)
+    return np.bincount(bins, minlength=len(edges) - 1)
 
 def calc_slope(dataframe, lookback):
     avg_bar = dataframe.mean()
@@ -102,6 +396,14 @@ def angle_between_slopes(slope1, slope2):
 def clean_cos(cos_angle):
     return min(1,max(cos_angle,-1))
 
+# angle_between_slopes() for arrays of slopes, element by element. clean_cos() turns a NaN
+# cosine into 1 (an angle of 0), and so does this
+def angles_between_slopes(slopes1, slopes2):
+    magnitudes = np.sqrt(1 + slopes1**2) * np.sqrt(1 + slopes2**2)
+    dot_product = 1 + slopes1*slopes2
+    cosines = np.clip(dot_product / magnitudes, -1, 1)
+    return np.degrees(np.arccos(np.where(np.isnan(cosines), 1, cosines)))
+
 def convert_to_points(history): 
     points = []
     i = 0
@@ -116,12 +418,20 @@ def convert_to_points(history):
 # Segmented Least Squares Algorithm #
 #####################################
 
+# multiprocessing and os are only imported by SegmentationPool and SegmentStore, which are
+# opt-in: the hosted platform only lets an algorithm import the modules it whitelists
+import collections
+import hashlib
 import numpy
+import time
 
-# Describes a 2D point with an X and a Y coordinate
-class Point:
+# Describes a 2D point with an X and a Y coordinate. The algorithm itself works on x/y arrays,
+# Points are only made for the endpoints of the segments it returns
+class Point(object):
     """ Point class represents and manipulates x,y coords. """
 
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y):
         """ Create a new point at the origin """
         self.x = x
@@ -135,115 +445,1122 @@ class Point:
     
     
     
+# start and end are the (0-based) positions of p1 and p2 in the series that was segmented
 class Segment:
-    def __init__(self, p1, p2, slope, intercept, sqerr):
+    def __init__(self, p1, p2, slope, intercept, sqerr, start=None, end=None):
         self.p1 = p1
         self.p2 = p2
         self.slope = slope
         self.intercept = intercept
         self.sqerr = sqerr
+        self.start = start
+        self.end = end
 
     def __str__(self):
         return "POINT 1: %s, POINT 2: %s" % (self.p1, self.p2)
     
     def __repr__(self):
         return self.__str__()
-    
-# Takes a list of Point Objects (Ordered by X in ASC order) and a Constant C
-def segmented(points,C):
-    N = i = j = k = interval = 0
-    x_sum = 0
-    y_sum = 0
-    xy_sum = 0
-    xsqr_sum = 0
-    num = 0
-    denom = 0
-    tmp = 0.0
-    mn = 0.0
-    INF = 99999999999999
-    N = len(points)
+
+# The segments of one segmentation as parallel numpy arrays (0-based start and end positions,
+# slope, intercept and square error) plus cost, the total cost of the optimal solution (None
+# where it isn't defined). Indexing and iterating hand out Segment views built on the fly, so
+# reading e.g. result.slope[-1] never allocates a Segment at all. x and y are the points that
+# were segmented and give the views their endpoints; they are shared with the caller, not copied
+class SegmentationResult(object):
+    def __init__(self, start, end, slope, intercept, sqerr, cost=None, x=None, y=None):
+        self.start = start
+        self.end = end
+        self.slope = slope
+        self.intercept = intercept
+        self.sqerr = sqerr
+        self.cost = cost
+        self.x = x
+        self.y = y
+
+    def __len__(self):
+        return len(self.start)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[n] for n in range(*k.indices(len(self)))]
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("segment index out of range")
+        start = int(self.start[k])
+        end = int(self.end[k])
+        p1 = p2 = None
+        if self.y is not None:
+            p1 = Point(self.x[start], self.y[start])
+            p2 = Point(self.x[end], self.y[end])
+        return Segment(p1, p2, self.slope[k], self.intercept[k], self.sqerr[k], start, end)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def __str__(self):
+        return str(list(self))
+
+    def __repr__(self):
+        return self.__str__()
+
+INF = 99999999999999
+
+# segmented() and segmented_batch() take an optional profiler: any callable, which gets one
+# report dict per call with the seconds spent in each phase ('prefix', 'errors', 'opt' and
+# 'backtrack') and the counters 'n', 'candidates' (segment starts evaluated) and 'segments'.
+# Without one the only cost is a None check per phase
+timer = getattr(time, 'perf_counter', time.time)
+
+class PhaseTimer:
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.report = {}
+        self.last = timer()
+
+    # Charges the time since the last lap to the given phase
+    def lap(self, phase):
+        now = timer()
+        self.report[phase] = self.report.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def done(self, **counters):
+        self.report.update(counters)
+        self.profiler(self.report)
+
+# A profiler that adds up the reports of every call it is given, e.g. over a whole backtest
+class SegmentationProfile:
+    PHASES = ('prefix', 'errors', 'opt', 'backtrack')
+    COUNTERS = ('n', 'candidates', 'segments')
+
+    def __init__(self):
+        self.reset()
+
+    def __call__(self, report):
+        self.calls += 1
+        for key in self.PHASES + self.COUNTERS:
+            self.totals[key] += report.get(key, 0)
+
+    def reset(self):
+        self.calls = 0
+        self.totals = dict.fromkeys(self.PHASES + self.COUNTERS, 0)
+
+    def summary(self):
+        seconds = sum(self.totals[phase] for phase in self.PHASES)
+        phases = ", ".join("%s %.3fs" % (phase, self.totals[phase]) for phase in self.PHASES)
+        return "%d calls in %.3fs (%s), %d points, %d candidates, %d segments" % (self.calls, seconds, phases, self.totals['n'], self.totals['candidates'], self.totals['segments'])
+
+# Number of segment starts the full recurrence evaluates for N points, when segments can
+# be at most max_length points long
+def candidate_count(N, max_length=None):
+    if max_length is None or max_length >= N:
+        return N * (N+1) // 2
+    return max_length * (max_length+1) // 2 + (N - max_length) * max_length
+
+# Takes the points to segment in any of the forms segmented() accepts and returns them as x and
+# y arrays, without copying anything that already is a float64 array:
+#  - a list of Point objects
+#  - an (x, y) pair of arrays (a tuple of two sequences, unlike a tuple of two Points)
+#  - a single array of y values, with x = 0..N-1
+#  - a pandas Series, with its index as x (datetimes become epoch nanoseconds)
+def as_xy(points):
+    if isinstance(points, tuple) and len(points) == 2 and all(hasattr(part, '__len__') for part in points):
+        x, y = points
+    elif hasattr(points, 'index') and hasattr(points, 'values'):
+        y = points.values
+        x = points.index.values
+        if x.dtype.kind == 'M':
+            x = x.view('i8')
+    elif isinstance(points, numpy.ndarray):
+        y = points
+        x = numpy.arange(len(y))
+    else:
+        x = [p.x for p in points]
+        y = [p.y for p in points]
+    return numpy.asarray(x, dtype=float), numpy.asarray(y, dtype=float)
+
+# Relative slack used when pruning candidate segment starts in opt_recurrence_pruned()
+PRUNE_TOLERANCE = 1e-9
+
+# cumulative.x[i] is sum(points[j].x - x0) for 1 <= j <= i (and likewise for y, xy, xSqr, ySqr)
+# so the sum over the points {points[i], ..., points[j]} is cumulative.x[j] - cumulative.x[i-1].
+# The points are shifted by the origin (x0, y0) before they are summed: slopes and square errors
+# don't depend on it, only the intercepts are moved back to the original coordinates
+PrefixSums = collections.namedtuple('PrefixSums', ['x', 'y', 'xy', 'xSqr', 'ySqr', 'x0', 'y0'])
+PrefixSums.__new__.__defaults__ = (0.0, 0.0)
+
+# Either y is a single series of N values, or an (S, N) array of S series that share the same
+# x, in which case the y, xy and ySqr sums are (S, N+1) arrays and the x sums are computed once.
+# Everything is summed relative to the first point of each series, so large x values (e.g.
+# epoch timestamps) don't swamp the interval * xsqr_sum - x_sum * x_sum differences, and integer
+# valued points stay exact. compensated=True also adds back the rounding error of every step of
+# the running sums, for very long series. O(n)
+def prefix_sums(x, y, compensated=False):
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    x0 = x[0] if x.shape[-1] > 0 else 0.0
+    y0 = y[..., 0] if y.shape[-1] > 0 else numpy.zeros(y.shape[:-1])
+    x = x - x0
+    y = y - y0[..., numpy.newaxis]
+    return PrefixSums(cumulative_sum(x, compensated), cumulative_sum(y, compensated), cumulative_sum(x * y, compensated), cumulative_sum(x * x, compensated), cumulative_sum(y * y, compensated), x0, y0)
+
+def cumulative_sum(values, compensated=False):
+    cumulative = numpy.zeros(values.shape[:-1] + (values.shape[-1] + 1,))
+    numpy.cumsum(values, axis=-1, out=cumulative[..., 1:])
+    if compensated:
+        # the exact rounding error of each addition cumulative[k-1] + values[k-1] (TwoSum),
+        # all at once since every partial sum is already known
+        before = cumulative[..., :-1]
+        after = cumulative[..., 1:]
+        added = after - before
+        error = (before - (after - added)) + (values - added)
+        cumulative[..., 1:] += numpy.cumsum(error, axis=-1)
+    return cumulative
+
+# Computes the slope, intercept and square error of the line that is best fit to the
+# points {points[i], ..., points[j]} straight from the prefix sums. i and j may be
+# scalars or numpy arrays of any broadcastable shape, batched sums add a leading series axis.
+# O(1) per (i, j) pair
+def segment_stats(cumulative, i, j):
+    interval = j - i + 1
+    x_sum = cumulative.x[..., j] - cumulative.x[..., i-1]
+    y_sum = cumulative.y[..., j] - cumulative.y[..., i-1]
+    xy_sum = cumulative.xy[..., j] - cumulative.xy[..., i-1]
+    xsqr_sum = cumulative.xSqr[..., j] - cumulative.xSqr[..., i-1]
+    ysqr_sum = cumulative.ySqr[..., j] - cumulative.ySqr[..., i-1]
+
+    num = interval * xy_sum - x_sum * y_sum
+    denom = interval * xsqr_sum - x_sum * x_sum
+
+    # A single point (or a run with no x/y covariance) is fit by a flat line. Several points
+    # sharing one x can't be fit by a function of x at all, so they get an "infinite" slope
+    flat = (num == 0) | (interval == 1)
+    vertical = (denom == 0) & ~flat
+    fitted = ~(flat | vertical)
+    safe_denom = numpy.where(fitted, denom, 1.0)
+
+    slope = numpy.where(flat, 0.0, numpy.where(vertical, INF, num / safe_denom))
+    # batched origins get one axis per axis of (i, j) to line up with the sums
+    y0 = numpy.reshape(cumulative.y0, numpy.shape(cumulative.y0) + (1,) * numpy.ndim(interval))
+    intercept = (y_sum - slope * x_sum) / interval + y0 - slope * cumulative.x0
+
+    # sum((y - slope * x - intercept)^2) over the segment is the variance of y about its
+    # mean minus the part of it explained by the line
+    sqerr = (ysqr_sum - y_sum * y_sum / interval) - numpy.where(fitted, num * num / (interval * safe_denom), 0.0)
+    return slope, intercept, numpy.maximum(sqerr, 0.0)
+
+# Just the square errors of segment_stats(), bit for bit, for the DP. Everything that only
+# depends on x is worked out once for the (i, j) pairs, so a batch of series adds little more
+# than three sums and a division per series. With joint=True the errors of the series along
+# the last batch axis are added up (see segmented_joint), and so are their y * y sums and
+# explained variances before anything is divided. O(1) per (i, j) pair
+def segment_sqerr(cumulative, i, j, joint=False):
+    interval = j - i + 1
+    x_sum = cumulative.x[..., j] - cumulative.x[..., i-1]
+    xsqr_sum = cumulative.xSqr[..., j] - cumulative.xSqr[..., i-1]
+    denom = interval * xsqr_sum - x_sum * x_sum
+    # flat and vertical segments explain none of the variance: num * num / inf is 0
+    divisor = numpy.where((interval == 1) | (denom == 0), numpy.inf, interval * denom)
+
+    y_sum = cumulative.y[..., j] - cumulative.y[..., i-1]
+    xy_sum = cumulative.xy[..., j] - cumulative.xy[..., i-1]
+    num = interval * xy_sum - x_sum * y_sum
+    if joint:
+        axis = -1 - numpy.ndim(interval)
+        ySqr = cumulative.ySqr.sum(axis=-2)
+        ysqr_sum = ySqr[..., j] - ySqr[..., i-1]
+        return numpy.maximum((ysqr_sum - (y_sum * y_sum).sum(axis=axis) / interval) - (num * num).sum(axis=axis) / divisor, 0.0)
+    ysqr_sum = cumulative.ySqr[..., j] - cumulative.ySqr[..., i-1]
+    return numpy.maximum((ysqr_sum - y_sum * y_sum / interval) - num * num / divisor, 0.0)
+
+# Builds the (N+1)*(N+1) matrix E with E[i][j] the square error of the segment
+# {points[i], ..., points[j]}. Only the upper triangle is filled in. Batched sums give an
+# (S, N+1, N+1) matrix. The slope and intercept of the segments that end up in the solution
+# are recomputed from the prefix sums afterwards, so they don't need matrices of their own.
+# joint=True adds up the matrices of the series along the last batch axis (see segment_sqerr). O(n^2)
+def error_matrix(cumulative, N, joint=False):
+    i = numpy.arange(1, N+1)[:, numpy.newaxis]
+    j = numpy.arange(1, N+1)[numpy.newaxis, :]
+    upper = j >= i
 
     # Multi dimentional array that is N*N in size
-    slope = numpy.zeros((N+1, N+1))
-    intercept = numpy.zeros((N+1, N+1))
-    E = numpy.zeros((N+1, N+1))
+    E = numpy.zeros(cumulative.y.shape[:-2 if joint else -1] + (N+1, N+1))
+    E[..., 1:, 1:] = numpy.where(upper, segment_sqerr(cumulative, numpy.where(upper, i, j), j, joint), 0.0)
+    return E
 
-    # precompute the error terms
-    cumulative_x = [None]*(N+1)
-    cumulative_y = [None]*(N+1)
-    cumulative_xy = [None]*(N+1)
-    cumulative_xSqr = [None]*(N+1)
-    cumulative_x[0] = cumulative_y[0] = cumulative_xy[0] = cumulative_xSqr[0] = 0
-    
-    # O(n^3)
-    for j in range(1,N+1):
-        cumulative_x[j] = cumulative_x[j-1] + points[j-1].x;
-        cumulative_y[j] = cumulative_y[j-1] + points[j-1].y;
-        cumulative_xy[j] = cumulative_xy[j-1] + points[j-1].x * points[j-1].y;
-        cumulative_xSqr[j] = cumulative_xSqr[j-1] + points[j-1].x * points[j-1].x;
-        # O(n^2)
-        for i in range(1,j+1):
-            interval = j - i + 1
-            x_sum = cumulative_x[j] - cumulative_x[i-1]
-            y_sum = cumulative_y[j] - cumulative_y[i-1]
-            xy_sum = cumulative_xy[j] - cumulative_xy[i-1]
-            xsqr_sum = cumulative_xSqr[j] - cumulative_xSqr[i-1]
+# OPT[j] is the optimal solution (minimum cost) for the points {points[1], ..., points[j]} and
+# [opt_segment[j], j] is the last segment in that solution. Each step takes the minimum over
+# every candidate start at once, across all series when E is batched. O(n^2)
+def opt_recurrence(E, N, C):
+    OPT = numpy.zeros(E.shape[:-2] + (N+1,))
+    opt_segment = numpy.zeros(E.shape[:-2] + (N+1,), dtype=int)
 
-            num = interval * xy_sum - x_sum * y_sum
+    # O(n)
+    for j in range(1, N+1):
+        tmp = E[..., 1:j+1, j] + OPT[..., :j]
+        # argmin keeps the first (smallest) start on ties
+        k = numpy.argmin(tmp, axis=-1)
+        OPT[..., j] = numpy.min(tmp, axis=-1) + C
+        opt_segment[..., j] = k + 1
 
-            if (num == 0):
-                slope[i][j] = 0.0
-            else:
-                denom = interval * xsqr_sum - x_sum * x_sum
-                slope[i][j] = INF if (denom == 0) else (num / float(denom))
+    return OPT, opt_segment
 
-            intercept[i][j] = (y_sum - slope[i][j] * x_sum) / interval
+# Same recurrence as opt_recurrence() but each column E[1..j][j] is computed from the prefix
+# sums when it is needed and thrown away afterwards, so memory stays O(n). Gives the same
+# values as the full matrix, bit for bit. O(n^2) time, or O(n * max_length) when segments
+# can't be longer than max_length points
+def opt_recurrence_low_memory(cumulative, N, C, max_length=None):
+    OPT = numpy.zeros(N+1)
+    opt_segment = numpy.zeros(N+1, dtype=int)
+    starts = numpy.arange(1, N+1)
 
-            E[i][j] = 0.0
-            
-            # O(n)
-            for k in range(i,j+1):
-                tmp = points[k-1].y - slope[i][j] * points[k-1].x - intercept[i][j]
-                E[i][j] += tmp * tmp;
+    # O(n)
+    for j in range(1, N+1):
+        first = 1 if max_length is None else max(1, j - max_length + 1)
+        tmp = segment_sqerr(cumulative, starts[first-1:j], j) + OPT[first-1:j]
+        k = numpy.argmin(tmp)
+        OPT[j] = tmp[k] + C
+        opt_segment[j] = first + k
 
+    return OPT, opt_segment
 
+# Same recurrence as opt_recurrence() for segments of at most L points. Only the band of E with
+# j - L < i <= j is built, stored as B[j][d] = E[j-L+1+d][j], so both the error terms and the
+# recurrence are O(n * L) instead of O(n^2). Batched sums give an (S, N+1, L) band
+def opt_recurrence_banded(cumulative, N, C, L):
+    return band_recurrence(error_band(cumulative, N, L), N, C, L)
+
+def error_band(cumulative, N, L, joint=False):
+    j = numpy.arange(N+1)[:, numpy.newaxis]
+    i = j - L + 1 + numpy.arange(L)[numpy.newaxis, :]
+    inside = (i >= 1) & (j >= 1)
+    return numpy.where(inside, segment_sqerr(cumulative, numpy.where(inside, i, 1), numpy.where(inside, j, 1), joint), numpy.inf)
+
+def band_recurrence(B, N, C, L):
+    # OPT[m] is kept at OPT[m+L-1] after L-1 padding zeros, so OPT[i-1] for every i in the band
+    # is the slice starting at j-1
+    OPT = numpy.zeros(B.shape[:-2] + (N+L,))
+    opt_segment = numpy.zeros(B.shape[:-2] + (N+1,), dtype=int)
 
-    # find the cost of the optimal solution
-    OPT = [None]*(N+1)
-    opt_segment = [None]*(N+1)
-    OPT[0] = 0
-    opt_segment[0] = 0;
-    
     # O(n)
     for j in range(1, N+1):
-        mn = INF
-        k = 0
-        for i in range(1, j+1):
-            tmp = E[i][j] + OPT[i-1];
-            if (tmp < mn) :
-                mn = tmp
-                k = i
+        tmp = B[..., j, :] + OPT[..., j-1:j-1+L]
+        k = numpy.argmin(tmp, axis=-1)
+        OPT[..., j+L-1] = numpy.min(tmp, axis=-1) + C
+        opt_segment[..., j] = j - L + 1 + k
 
-        OPT[j] = mn + C
-        opt_segment[j] = k
+    return OPT[..., L-1:], opt_segment
 
-    # find the optimal solution
+# Walks opt_segment back from N and returns the [i, j] bounds of every segment of the
+# optimal solution in order. O(n)
+def backtrack(opt_segment, N):
     segments = []
     i = N
     j = opt_segment[N]
-    # O(n)
     while (i > 0):
-        segments.append(i)
-        segments.append(j)
+        segments.append((j, i))
         i = j-1
         j = opt_segment[i]
+    segments.reverse()
+    return segments
 
-    returns = []
+# Fits every [i, j] segment in bounds (see backtrack) to the points at once. O(segments)
+def fit_segments(cumulative, bounds, x, y, cost=None):
+    i, j = numpy.array(bounds, dtype=int).reshape(-1, 2).T
+    slope, intercept, sqerr = segment_stats(cumulative, i, j)
+    return SegmentationResult(i-1, j-1, slope, intercept, sqerr, cost, x, y)
+
+# Exact pruned (PELT style) version of opt_recurrence() that never builds E. Splitting a segment
+# never increases its square error, so once E[i][j] + OPT[i-1] > OPT[j] the start i can never
+# beat the start j+1 again and is dropped for good. With breakpoints spread through the series
+# only a handful of starts survive each step, which is close to O(n) work and O(n) memory
+def opt_recurrence_pruned(cumulative, N, C, max_length=None, counters=None):
+    OPT = numpy.zeros(N+1)
+    opt_segment = numpy.zeros(N+1, dtype=int)
+    candidates = numpy.zeros(0, dtype=int)
+
+    # O(n * candidates)
+    for j in range(1, N+1):
+        if counters is not None:
+            counters['candidates'] += len(candidates) + 1
+        candidates = pruned_step(cumulative, OPT, opt_segment, candidates, j, C, max_length)
+
+    return OPT, opt_segment
+
+# Fills in OPT[j] and opt_segment[j] from the surviving candidate starts plus the start j and
+# returns the candidates that are still worth keeping for j+1
+def pruned_step(cumulative, OPT, opt_segment, candidates, j, C, max_length=None):
+    candidates = numpy.append(candidates, j)
+    if max_length is not None:
+        candidates = candidates[candidates > j - max_length]
+    tmp = segment_sqerr(cumulative, candidates, j) + OPT[candidates - 1]
+    # candidates stay sorted so argmin keeps the first (smallest) start on ties
+    k = numpy.argmin(tmp)
+    OPT[j] = tmp[k] + C
+    opt_segment[j] = candidates[k]
+
+    # only prune strictly worse starts (with some slack for rounding in the prefix sums)
+    # so ties are still broken exactly like the full recurrence does
+    return candidates[tmp <= OPT[j] + PRUNE_TOLERANCE * (1 + abs(OPT[j]))]
+
+# Takes a list of Point Objects (Ordered by X in ASC order), or x/y arrays (see as_xy), and a
+# Constant C. With pruned=True the exact pruned recurrence is used instead of the full error matrix,
+# which gives the same segments on series far too long for the O(n^2) version. With
+# low_memory=True the full recurrence runs without the N*N matrix, in O(n) memory.
+# max_length caps the number of points in a segment, which bounds the work to O(n * max_length).
+# compensated=True sums the points with compensated summation (see prefix_sums).
+# verbose=True prints every segment of the solution, see PhaseTimer for profiler
+def segmented(points,C,pruned=False,low_memory=False,max_length=None,profiler=None,verbose=False,compensated=False):
+    phases = None if profiler is None else PhaseTimer(profiler)
+    x, y = as_xy(points)
+    N = len(x)
+
+    # precompute the error terms
     # O(n)
-    while (segments != []):
-        i = segments.pop()
-        j = segments.pop()
-        print "Segment (y = %f * x + %f) from point #%d: %d %d to point #%d: %d %d with square error %lf." % (slope[i][j], intercept[i][j], i, points[i-1].x, points[i-1].y, j, points[j-1].x, points[j-1].y, E[i][j])
-        returns.append(Segment(points[i-1], points[j-1],slope[i][j], intercept[i][j], E[i][j]))
+    cumulative = prefix_sums(x, y, compensated)
+    if phases is not None:
+        phases.lap('prefix')
 
+    # find the cost of the optimal solution
+    if pruned:
+        counters = None if phases is None else {'candidates': 0}
+        OPT, opt_segment = opt_recurrence_pruned(cumulative, N, C, max_length, counters)
+        candidates = None if phases is None else counters['candidates']
+    elif low_memory:
+        OPT, opt_segment = opt_recurrence_low_memory(cumulative, N, C, max_length)
+        candidates = candidate_count(N, max_length)
+    elif max_length is not None and max_length < N:
+        # O(n * max_length)
+        OPT, opt_segment = opt_recurrence_banded(cumulative, N, C, max_length)
+        candidates = candidate_count(N, max_length)
+    else:
+        # O(n^2)
+        E = error_matrix(cumulative, N)
+        if phases is not None:
+            phases.lap('errors')
+        OPT, opt_segment = opt_recurrence(E, N, C)
+        candidates = candidate_count(N)
+    if phases is not None:
+        phases.lap('opt')
+
+    # find the optimal solution
+    # O(n)
+    returns = fit_segments(cumulative, backtrack(opt_segment, N), x, y, float(OPT[N]))
+    if verbose:
+        for segment in returns:
+            print("Segment (y = %f * x + %f) from point #%d: %d %d to point #%d: %d %d with square error %lf." % (segment.slope, segment.intercept, segment.start+1, segment.p1.x, segment.p1.y, segment.end+1, segment.p2.x, segment.p2.y, segment.sqerr))
+
+    if phases is not None:
+        phases.lap('backtrack')
+        phases.done(n=N, candidates=candidates, segments=len(returns))
+    return returns
+
+# Takes an (S, N) array of S series (e.g. the transposed high or low history frame) that are
+# all sampled at the same x, 0..N-1 unless given, and a Constant C. Every series is segmented
+# in the same numpy pass and the SegmentationResult of each one is returned in order
+def segmented_batch(series, C, x=None, max_length=None, profiler=None, compensated=False):
+    phases = None if profiler is None else PhaseTimer(profiler)
+    series = numpy.asarray(series, dtype=float)
+    S, N = series.shape
+    x = numpy.arange(N) if x is None else numpy.asarray(x, dtype=float)
+
+    cumulative = prefix_sums(x, series, compensated)
+    if phases is not None:
+        phases.lap('prefix')
+    if max_length is not None and max_length < N:
+        # O(s * n * max_length)
+        OPT, opt_segment = opt_recurrence_banded(cumulative, N, C, max_length)
+    else:
+        # O(s * n^2)
+        E = error_matrix(cumulative, N)
+        if phases is not None:
+            phases.lap('errors')
+        OPT, opt_segment = opt_recurrence(E, N, C)
+    if phases is not None:
+        phases.lap('opt')
+
+    returns = []
+    # O(s * n)
+    for s in range(S):
+        series_cumulative = PrefixSums(cumulative.x, cumulative.y[s], cumulative.xy[s], cumulative.xSqr, cumulative.ySqr[s], cumulative.x0, cumulative.y0[s])
+        returns.append(fit_segments(series_cumulative, backtrack(opt_segment[s], N), x, series[s], float(OPT[s, N])))
+
+    if phases is not None:
+        phases.lap('backtrack')
+        phases.done(n=N, series=S, candidates=S * candidate_count(N, max_length), segments=sum(len(segments) for segments in returns))
     return returns
+
+# Segments K series that share the same x (e.g. the highs and the lows of a security) with one
+# set of breakpoints: the error of a segment is the sum of its square errors in every series,
+# but each series gets its own line through it. series is a (K, N) array, or (S, K, N) for S
+# groups at once, and x is 0..N-1 unless given. The x sums, the error matrix and the OPT
+# recurrence are computed once for all K series. Returns the K SegmentationResults of a group
+# (a list of them per group when batched), all with the same bounds and with the total cost of
+# the joint solution as their cost. O(s * n^2), or O(s * n * max_length)
+def segmented_joint(series, C, x=None, max_length=None):
+    series = numpy.asarray(series, dtype=float)
+    batched = series.ndim == 3
+    if not batched:
+        series = series[numpy.newaxis]
+    S, K, N = series.shape
+    x = numpy.arange(N) if x is None else numpy.asarray(x, dtype=float)
+
+    cumulative = prefix_sums(x, series)
+    if max_length is not None and max_length < N:
+        # O(s * n * max_length)
+        OPT, opt_segment = band_recurrence(error_band(cumulative, N, max_length, joint=True), N, C, max_length)
+    else:
+        # O(s * n^2)
+        OPT, opt_segment = opt_recurrence(error_matrix(cumulative, N, joint=True), N, C)
+
+    returns = []
+    # O(s * k * n)
+    for s in range(S):
+        group_cumulative = PrefixSums(cumulative.x, cumulative.y[s], cumulative.xy[s], cumulative.xSqr, cumulative.ySqr[s], cumulative.x0, cumulative.y0[s])
+        i, j = numpy.array(backtrack(opt_segment[s], N), dtype=int).reshape(-1, 2).T
+        slope, intercept, sqerr = segment_stats(group_cumulative, i, j)
+        returns.append([SegmentationResult(i-1, j-1, slope[k], intercept[k], sqerr[k], float(OPT[s, N]), x, series[s, k]) for k in range(K)])
+
+    return returns if batched else returns[0]
+
+# Takes a list of Point Objects (Ordered by X in ASC order), or x/y arrays (see as_xy), and a
+# maximum number of segments K. Returns the segments of the exact best fit that uses at most
+# K segments (with its total square error as the cost) along with errors[k-1], the least total
+# square error of any fit with exactly k segments, for every k = 1..K. One run gives the whole
+# error curve. O(K * n^2)
+def segmented_k(points, K):
+    x, y = as_xy(points)
+    N = len(x)
+    K = min(K, N)
+    cumulative = prefix_sums(x, y)
+    upper = numpy.triu(numpy.ones((N, N), dtype=bool))
+    E = numpy.where(upper, error_matrix(cumulative, N)[1:, 1:], numpy.inf)
+
+    # D[k][j] is the least error of the points {points[1], ..., points[j]} in exactly k
+    # segments and [opt_segment[k][j], j] is the last of those segments
+    D = numpy.full((K+1, N+1), numpy.inf)
+    D[0][0] = 0
+    opt_segment = numpy.zeros((K+1, N+1), dtype=int)
+
+    # O(K)
+    for k in range(1, K+1):
+        # O(n^2) all at once: row i-1 holds the candidate start i for every end j
+        tmp = D[k-1][:N, numpy.newaxis] + E
+        D[k][1:] = numpy.min(tmp, axis=0)
+        opt_segment[k][1:] = numpy.argmin(tmp, axis=0) + 1
+
+    errors = D[1:, N]
+    # the fewest segments that reach the least error
+    k = int(numpy.argmin(errors)) + 1
+
+    bounds = []
+    j = N
+    while (k > 0):
+        i = opt_segment[k][j]
+        bounds.append((i, j))
+        j = i-1
+        k -= 1
+    bounds.reverse()
+
+    return fit_segments(cumulative, bounds, x, y, float(errors[len(bounds)-1])), errors
+
+# Takes the points (see as_xy) and an interval [C_min, C_max] of segment costs and returns every
+# distinct optimal segmentation in it as (C_low, C_high, segments), from the lowest cost up,
+# where the segments are optimal for every C in [C_low, C_high] (their cost is left as None, it
+# depends on C). The cost of a solution with m
+# segments and total square error Q is Q + m * C, a line in C, so the optimal cost over C is
+# the lower envelope of those lines. Starting from both ends of the interval, the DP is rerun
+# where the lines of the two nearest solutions cross until no solution lies between them
+# (CROPS). That takes about two DP runs per distinct segmentation, all over one error matrix
+def segmented_path(points, C_min, C_max):
+    x, y = as_xy(points)
+    N = len(x)
+    cumulative = prefix_sums(x, y)
+    # O(n^2), once
+    E = error_matrix(cumulative, N)
+
+    # number of segments -> (C it was found at, segment bounds, total square error)
+    solutions = {}
+    def solve(C):
+        OPT, opt_segment = opt_recurrence(E, N, C)
+        bounds = backtrack(opt_segment, N)
+        m = len(bounds)
+        if m not in solutions:
+            solutions[m] = (C, bounds, OPT[N] - m * C)
+        return m
+
+    intervals = [(solve(C_min), solve(C_max))]
+    while intervals:
+        m_low, m_high = intervals.pop()
+        if m_low <= m_high + 1:
+            continue
+        C = (solutions[m_high][2] - solutions[m_low][2]) / float(m_low - m_high)
+        m = solve(C)
+        if m_high < m < m_low:
+            intervals.append((m_low, m))
+            intervals.append((m, m_high))
+
+    # costs go up as the number of segments goes down
+    ms = sorted(solutions, reverse=True)
+    returns = []
+    for n, m in enumerate(ms):
+        C_low = C_min if n == 0 else (solutions[m][2] - solutions[ms[n-1]][2]) / float(ms[n-1] - m)
+        C_high = C_max if n == len(ms) - 1 else (solutions[ms[n+1]][2] - solutions[m][2]) / float(m - ms[n+1])
+        C_low = min(max(C_low, C_min), C_max)
+        C_high = min(max(C_high, C_min), C_max)
+        if C_low > C_high:
+            continue
+
+        returns.append((C_low, C_high, fit_segments(cumulative, solutions[m][1], x, y)))
+
+    return returns
+
+# Same pruned recurrence as opt_recurrence_pruned(), but segments may only end at the given
+# positions (sorted, the last one N). Pruning stays exact: a start that loses at an allowed end
+# j also loses to the start j+1 later on. Returns the total cost and the [i, j] bounds of the
+# segments. O(ends * candidates)
+def opt_recurrence_restricted(cumulative, ends, C):
+    positions = numpy.concatenate(([0], ends))
+    OPT = numpy.zeros(len(positions))
+    opt_segment = numpy.zeros(len(positions), dtype=int)
+    candidates = numpy.zeros(0, dtype=int)
+
+    for m in range(1, len(positions)):
+        # candidates are indices into positions of the end of the segment before
+        candidates = numpy.append(candidates, m-1)
+        tmp = segment_sqerr(cumulative, positions[candidates] + 1, positions[m]) + OPT[candidates]
+        k = numpy.argmin(tmp)
+        OPT[m] = tmp[k] + C
+        opt_segment[m] = candidates[k]
+        candidates = candidates[tmp <= OPT[m] + PRUNE_TOLERANCE * (1 + abs(OPT[m]))]
+
+    bounds = []
+    m = len(positions) - 1
+    while m > 0:
+        bounds.append((positions[opt_segment[m]] + 1, positions[m]))
+        m = opt_segment[m]
+    bounds.reverse()
+    return OPT[-1], bounds
+
+# Approximate segmentation of very long series. Segments are first only allowed to end on a
+# coarse grid of every step-th point, with step a power of factor that leaves at most about
+# coarse_size grid points, and the DP is run over the grid with the exact square errors of the
+# full series. Then step is divided by factor and the DP rerun with ends allowed only on the finer
+# grid within one old step of the breakpoints found so far, down to single points. Every pass
+# keeps the breakpoints of the one before, so the cost is never more than the optimum over the
+# coarse grid, but that is the only guarantee: this is a heuristic, and nothing bounds how far
+# the result is from the exact optimum. Moving breakpoints onto the grid can cost any amount of
+# error, depending on the data. When segments are many coarse steps long it typically comes
+# out within a small fraction of a percent; with segments around a step long (a random walk
+# with a low C, say) it can be several percent off. Series of up to coarse_size points are
+# segmented exactly. Returns the segments and, with exact=True, their cost minus the exact
+# optimum (from the pruned recurrence, which takes as long as segmenting the series exactly),
+# the only way to know the gap; None otherwise. O(n + (n / step)^2 + passes * segments * factor)
+def segmented_approx(points, C, factor=4, coarse_size=1000, exact=False):
+    x, y = as_xy(points)
+    N = len(x)
+    cumulative = prefix_sums(x, y)
+
+    step = 1
+    while N > step * coarse_size:
+        step *= factor
+
+    ends = numpy.minimum(numpy.arange(step, N + step, step), N)
+    cost, bounds = opt_recurrence_restricted(cumulative, ends, C)
+    while step > 1:
+        old = step
+        step = max(step // factor, 1)
+        breakpoints = numpy.array([j for i, j in bounds[:-1]], dtype=int)
+        # every multiple of step within old of a breakpoint
+        near = (breakpoints[:, numpy.newaxis] // step + numpy.arange(-(old // step), old // step + 1)[numpy.newaxis, :]) * step
+        ends = numpy.unique(numpy.concatenate((near.ravel(), breakpoints, [N])))
+        ends = ends[(ends >= 1) & (ends <= N)]
+        cost, bounds = opt_recurrence_restricted(cumulative, ends, C)
+
+    gap = None
+    if exact:
+        OPT, opt_segment = opt_recurrence_pruned(cumulative, N, C)
+        gap = float(cost - OPT[N])
+    return fit_segments(cumulative, bounds, x, y, float(cost)), gap
+
+# An in-process LRU cache in front of segmented() and segmented_batch(). Entries are keyed by a
+# SHA-1 of the x and y buffers plus C and any other options, so repeated windows cost a hash of
+# 16 bytes per point instead of a full DP. The cached segment lists are shared between callers,
+# so they must not be modified
+class SegmentationCache:
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def segmented(self, points, C, **options):
+        x, y = as_xy(points)
+        key = self.key(x, y, C, options)
+        segments = self.get(key)
+        if segments is None:
+            # the cached segments keep their points, which mustn't change under them when the
+            # caller reuses its buffers (series[missed] below is a copy already)
+            segments = segmented((x.copy(), y.copy()), C, **options)
+            self.put(key, segments)
+        return segments
+
+    # Looks every series up on its own and only runs the ones that missed through segmented_batch
+    def segmented_batch(self, series, C, x=None, **options):
+        series = numpy.asarray(series, dtype=float)
+        S, N = series.shape
+        if x is None:
+            x = numpy.arange(N)
+        x = numpy.asarray(x, dtype=float)
+
+        keys = [self.key(x, series[s], C, options) for s in range(S)]
+        returns = [self.get(key) for key in keys]
+        missed = [s for s in range(S) if returns[s] is None]
+        if missed:
+            for s, segments in zip(missed, segmented_batch(series[missed], C, x=x, **options)):
+                self.put(keys[s], segments)
+                returns[s] = segments
+        return returns
+
+    # profiler and verbose don't change the result, so they aren't part of the key
+    def key(self, x, y, C, options):
+        options = dict((name, value) for name, value in options.items() if name not in ('profiler', 'verbose'))
+        digest = hashlib.sha1(numpy.ascontiguousarray(x))
+        digest.update(numpy.ascontiguousarray(y))
+        return (len(x), digest.digest(), C, tuple(sorted(options.items())))
+
+    def get(self, key):
+        segments = self.entries.pop(key, None)
+        if segments is None:
+            self.misses += 1
+            return None
+        # re-inserting moves it to the most recently used end
+        self.entries[key] = segments
+        self.hits += 1
+        return segments
+
+    def put(self, key, segments):
+        self.entries[key] = segments
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.entries), 'maxsize': self.maxsize, 'hit_rate': self.hits / float(lookups) if lookups else 0.0}
+
+# Keeps the segmentation of the last `lookback` points of one series up to date as the window
+# rolls forward one point at a time (x is the position in the window, like convert_to_points).
+# E is shift invariant, so when the window moves the old matrix is shifted up and to the left
+# and only the column of the new point is computed; the OPT recurrence is then rerun over it,
+# which gives the same segments as segmented() on the window. If tolerance is set and the new
+# point lies within tolerance of the line of the last segment, the last segment is simply
+# extended to cover it and the E matrix and OPT recurrence aren't touched at all that bar
+class RollingSegmenter:
+    def __init__(self, C, lookback, tolerance=None):
+        self.C = C
+        self.lookback = lookback
+        self.tolerance = tolerance
+        self.y = numpy.zeros(0)
+        self.E = numpy.zeros((lookback+1, lookback+1))
+        # number of points at the end of the window whose column of E hasn't been computed yet
+        self.stale = 0
+        self.bounds = []
+        self.segments = None
+
+    # Throws away everything and segments the given window from scratch. O(n^2)
+    def reset(self, values):
+        self.y = numpy.array(values[-self.lookback:], dtype=float)
+        self.stale = len(self.y)
+        return self.recompute()
+
+    # Adds a new point at the end of the window, evicting the oldest once it is full
+    def update(self, value):
+        evicted = len(self.y) == self.lookback
+        self.y = numpy.append(self.y[1:] if evicted else self.y, float(value))
+        N = len(self.y)
+
+        if evicted:
+            # O(n^2) memory move, but no arithmetic
+            self.E[1:N, 1:N] = self.E[2:N+1, 2:N+1]
+            self.bounds = [(max(i-1, 1), j-1) for i, j in self.bounds if j > 1]
+        self.stale = min(self.stale + 1, N)
+
+        if self.tolerance is not None and self.bounds:
+            # the line of the last segment is still in the coordinates of the previous window
+            x = N if evicted else N-1
+            if abs(float(value) - (self.segments.slope[-1] * x + self.segments.intercept[-1])) <= self.tolerance:
+                i, j = self.bounds[-1]
+                self.bounds[-1] = (i, N)
+                return self.build()
+
+        return self.recompute()
+
+    # Feeds a whole history window (e.g. high_history[security]). When it is the last window
+    # moved on by one point only the new point is pushed, otherwise the state is rebuilt
+    def segment(self, window):
+        window = numpy.asarray(window, dtype=float)[-self.lookback:]
+        N = len(self.y)
+        if N > 0 and len(window) == min(N + 1, self.lookback) and numpy.array_equal(window[:-1], self.y[len(self.y) - len(window) + 1:]):
+            return self.update(window[-1])
+        if N > 0 and len(window) == N and numpy.array_equal(window, self.y):
+            return self.segments
+        return self.reset(window)
+
+    # Computes the columns of E that are missing and reruns the OPT recurrence. O(n^2)
+    def recompute(self):
+        N = len(self.y)
+        cumulative = prefix_sums(numpy.arange(N), self.y)
+        if self.stale > 0:
+            i = numpy.arange(1, N+1)[:, numpy.newaxis]
+            j = numpy.arange(N - self.stale + 1, N+1)[numpy.newaxis, :]
+            upper = j >= i
+            self.E[1:N+1, N-self.stale+1:N+1] = numpy.where(upper, segment_sqerr(cumulative, numpy.where(upper, i, j), j), 0.0)
+            self.stale = 0
+
+        OPT, opt_segment = opt_recurrence(self.E[:N+1, :N+1], N, self.C)
+        self.bounds = backtrack(opt_segment, N)
+        return self.build(cumulative, float(OPT[N]))
+
+    # Fits the current segment bounds to the points in the window. An extended last segment
+    # leaves the solution without a known optimal cost. O(n)
+    def build(self, cumulative=None, cost=None):
+        N = len(self.y)
+        if cumulative is None:
+            cumulative = prefix_sums(numpy.arange(N), self.y)
+        self.segments = fit_segments(cumulative, self.bounds, numpy.arange(N), self.y, cost)
+        return self.segments
+
+# RollingSegmenter for a whole universe at once, one row per security. E of every window is kept
+# in one (S, lookback+1, lookback+1) array, so when the windows roll forward the rows of the
+# securities that moved on by one point are shifted and their new column is computed for all of
+# them together, and the OPT recurrence is then run once over every row that changed. New
+# securities, and windows that didn't just move on by one point, get their rows of E built from
+# scratch; unchanged windows keep their segments. The tolerance works as for RollingSegmenter.
+# O(s * n^2) for the recurrence, but only O(s * n) of error terms on a regular bar
+class RollingBatchSegmenter:
+    def __init__(self, C, lookback, tolerance=None):
+        self.C = C
+        self.lookback = lookback
+        self.tolerance = tolerance
+        self.securities = []
+        self.y = numpy.zeros((0, 0))
+        self.E = numpy.zeros((0, 1, 1))
+        self.bounds = []
+        self.segments = []
+
+    # Feeds the windows (one row per security, in the order of securities) of this bar and
+    # returns the SegmentationResult of every row
+    def segment(self, securities, windows):
+        securities = list(securities)
+        # copied, the segments keep views of it
+        y = numpy.array(windows, dtype=float)[:, -self.lookback:]
+        S, N = y.shape
+        rows = dict((security, n) for n, security in enumerate(self.securities))
+        old = numpy.array([rows.get(security, -1) for security in securities], dtype=int)
+
+        same = numpy.zeros(S, dtype=bool)
+        moved = numpy.zeros(S, dtype=bool)
+        if self.y.shape[1] == N and N > 0:
+            known = numpy.flatnonzero(old >= 0)
+            previous = self.y[old[known]]
+            same[known] = (previous == y[known]).all(axis=1)
+            moved[known] = (previous[:, 1:] == y[known, :-1]).all(axis=1) & ~same[known]
+        rebuilt = ~(same | moved)
+
+        E = numpy.zeros((S, N+1, N+1))
+        cumulative = prefix_sums(numpy.arange(N), y)
+        if same.any():
+            E[same] = self.E[old[same]]
+        if moved.any():
+            # O(s * n^2) memory move, but no arithmetic
+            E[moved, 1:N, 1:N] = self.E[old[moved], 2:N+1, 2:N+1]
+            # O(s * n)
+            E[moved, 1:, N] = segment_sqerr(select_sums(cumulative, moved), numpy.arange(1, N+1), numpy.array([N]))
+        if rebuilt.any():
+            # O(s * n^2)
+            E[rebuilt] = error_matrix(select_sums(cumulative, rebuilt), N)
+
+        bounds = [None] * S
+        segments = [None] * S
+        for n in numpy.flatnonzero(same):
+            bounds[n] = self.bounds[old[n]]
+            segments[n] = self.segments[old[n]]
+        for n in numpy.flatnonzero(moved):
+            if self.tolerance is not None:
+                # the line of the last segment is still in the coordinates of the previous window
+                last = self.segments[old[n]]
+                if abs(y[n, -1] - (last.slope[-1] * N + last.intercept[-1])) <= self.tolerance:
+                    extended = [(max(i-1, 1), j-1) for i, j in self.bounds[old[n]] if j > 1]
+                    if extended:
+                        extended[-1] = (extended[-1][0], N)
+                        bounds[n] = extended
+                        segments[n] = fit_segments(select_sums(cumulative, n), extended, numpy.arange(N), y[n])
+
+        # O(s * n^2)
+        recompute = numpy.array([segments[n] is None for n in range(S)], dtype=bool)
+        if recompute.any():
+            OPT, opt_segment = opt_recurrence(E[recompute], N, self.C)
+            for k, n in enumerate(numpy.flatnonzero(recompute)):
+                bounds[n] = backtrack(opt_segment[k], N)
+                segments[n] = fit_segments(select_sums(cumulative, n), bounds[n], numpy.arange(N), y[n], float(OPT[k, N]))
+
+        self.securities = securities
+        self.y = y
+        self.E = E
+        self.bounds = bounds
+        self.segments = segments
+        return segments
+
+# The prefix sums of some of the series of batched sums, rows being an index or a mask
+def select_sums(cumulative, rows):
+    return PrefixSums(cumulative.x, cumulative.y[rows], cumulative.xy[rows], cumulative.xSqr, cumulative.ySqr[rows], cumulative.x0, cumulative.y0[rows])
+
+# Segments a stream of points that is pushed in one point or one chunk at a time, using the
+# same exact pruned recurrence as segmented(points, C, pruned=True). Every solution for a
+# longer stream ends with a segment that starts at one of the surviving candidates (or at the
+# next point) and agrees with the optimal solution up to that start, so the segments that all
+# of those solutions share can never change again. push() hands those back as soon as they are
+# known and the points they cover are dropped, keeping only the unresolved tail in memory
+class StreamingSegmenter:
+    def __init__(self, C, capacity=1024):
+        self.C = C
+        # the unresolved tail, its prefix sums and its OPT values all start at the last
+        # finalized point. offset is the number of points handed out in finalized segments
+        self.x = numpy.zeros(capacity)
+        self.y = numpy.zeros(capacity)
+        self.sums = numpy.zeros((5, capacity+1))
+        self.OPT = numpy.zeros(capacity+1)
+        self.opt_segment = numpy.zeros(capacity+1, dtype=int)
+        self.candidates = numpy.zeros(0, dtype=int)
+        self.N = 0
+        self.offset = 0
+        # the sums are taken relative to the first point of the stream, see prefix_sums
+        self.origin = None
+
+    # Adds one point (with x greater than the last one) and returns the segments it finalized
+    def push(self, x, y):
+        if self.N == len(self.x):
+            self.grow()
+        N = self.N = self.N + 1
+        self.x[N-1] = x
+        self.y[N-1] = y
+        if self.origin is None:
+            self.origin = (float(x), float(y))
+        dx = x - self.origin[0]
+        dy = y - self.origin[1]
+        self.sums[:, N] = self.sums[:, N-1] + (dx, dy, dx * dy, dx * dx, dy * dy)
+
+        cumulative = PrefixSums(*self.sums[:, :N+1], x0=self.origin[0], y0=self.origin[1])
+        self.candidates = pruned_step(cumulative, self.OPT, self.opt_segment, self.candidates, N, self.C)
+        return self.finalize(cumulative)
+
+    # Adds a chunk of points and returns the segments finalized along the way
+    def push_many(self, xs, ys):
+        returns = []
+        for x, y in zip(xs, ys):
+            returns.extend(self.push(x, y))
+        return returns
+
+    # Ends the stream: the optimal solution of the tail is final now. Returns its segments
+    def close(self):
+        returns = []
+        if self.N > 0:
+            cumulative = PrefixSums(*self.sums[:, :self.N+1], x0=self.origin[0], y0=self.origin[1])
+            returns = self.build(cumulative, backtrack(self.opt_segment, self.N))
+            self.trim(self.N)
+        return returns
+
+    # The end of the part of the solution that every candidate agrees on is the deepest common
+    # ancestor of their ends in the tree formed by opt_segment. O(unresolved segments)
+    def finalize(self, cumulative):
+        ends = set(int(i) - 1 for i in self.candidates)
+        ends.add(self.N)
+        while len(ends) > 1:
+            j = max(ends)
+            ends.remove(j)
+            ends.add(int(self.opt_segment[j]) - 1)
+
+        L = ends.pop()
+        if L <= 0:
+            return []
+        returns = self.build(cumulative, backtrack(self.opt_segment, L))
+        self.trim(L)
+        return returns
+
+    def build(self, cumulative, bounds):
+        returns = []
+        for i, j in bounds:
+            slope, intercept, sqerr = [float(v) for v in segment_stats(cumulative, i, j)]
+            returns.append(Segment(Point(self.x[i-1], self.y[i-1]), Point(self.x[j-1], self.y[j-1]), slope, intercept, sqerr, self.offset + i-1, self.offset + j-1))
+        return returns
+
+    # Forgets the first L points of the tail and rebases everything on the point after them. O(n)
+    def trim(self, L):
+        N = self.N - L
+        self.x[:N] = self.x[L:self.N]
+        self.y[:N] = self.y[L:self.N]
+        self.sums[:, :N+1] = self.sums[:, L:self.N+1] - self.sums[:, L:L+1]
+        self.OPT[:N+1] = self.OPT[L:self.N+1] - self.OPT[L]
+        self.opt_segment[:N+1] = self.opt_segment[L:self.N+1] - L
+        self.candidates = self.candidates - L
+        self.N = N
+        self.offset += L
+
+    def grow(self):
+        capacity = 2 * len(self.x)
+        self.x = numpy.resize(self.x, capacity)
+        self.y = numpy.resize(self.y, capacity)
+        self.sums = numpy.hstack((self.sums, numpy.zeros((5, capacity - self.sums.shape[1] + 1))))
+        self.OPT = numpy.resize(self.OPT, capacity+1)
+        self.opt_segment = numpy.resize(self.opt_segment, capacity+1)
+
+# Yields the segments of an iterable of Point objects (ordered by X in ASC order) as soon as they
+# are final, without ever holding more than the unresolved tail of the stream
+def stream_segments(points, C):
+    segmenter = StreamingSegmenter(C)
+    for p in points:
+        for segment in segmenter.push(p.x, p.y):
+            yield segment
+    for segment in segmenter.close():
+        yield segment
+
+# A process pool whose workers all see one shared float64 buffer of `capacity` values. Each
+# call copies the (2, S, N) high/low windows into the buffer once and only hands the workers
+# the bounds of their chunk of securities, so the windows themselves are never pickled
+class SegmentationPool:
+    def __init__(self, workers, capacity):
+        import multiprocessing
+        self.capacity = capacity
+        self.buffer = multiprocessing.RawArray('d', capacity)
+        self.pool = multiprocessing.Pool(workers, initializer=attach_shared_windows, initargs=(self.buffer,))
+
+    # Segments windows[:, start:stop] for every (start, stop) in tasks and returns the
+    # (segments_high, segments_low) lists of each task in the order of tasks. The results come
+    # back without their x and y, which the caller re-attaches from its own windows
+    def map(self, windows, tasks, C, max_length=None):
+        shared = numpy.frombuffer(self.buffer, dtype=float, count=windows.size)
+        shared[:] = windows.ravel()
+        shape = windows.shape
+        return self.pool.map(segment_shared_windows, [(shape, start, stop, C, max_length) for start, stop in tasks])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+# The shared buffer of the current worker process, set when the pool starts it
+shared_windows = None
+
+def attach_shared_windows(buffer):
+    global shared_windows
+    shared_windows = buffer
+
+def segment_shared_windows(task):
+    shape, start, stop, C, max_length = task
+    windows = numpy.frombuffer(shared_windows, dtype=float, count=shape[0] * shape[1] * shape[2]).reshape(shape)
+    returns = (segmented_batch(windows[0, start:stop], C, max_length=max_length), segmented_batch(windows[1, start:stop], C, max_length=max_length))
+    # x and y are views of the shared buffer; the parent has the windows, so don't pickle them back
+    for segments in returns[0] + returns[1]:
+        segments.x = segments.y = None
+    return returns
+
+# A persistent columnar store of segmentations for backtest replays, kept in a directory of raw
+# little-endian arrays: one fixed-width file per segment column and an index of records that
+# point at the rows of each segmentation. Everything is opened with numpy.memmap, so later runs
+# and parallel workers read segments straight out of the page cache without copying or parsing.
+# A segmentation is keyed by security (sid or symbol), date, field, segment cost, window length
+# and max_length (-1 for none). Only one process may write to a store at a time; put() buffers
+# and flush() appends to the files
+class SegmentStore:
+    COLUMNS = [('start', '<i4'), ('end', '<i4'), ('slope', '<f8'), ('intercept', '<f8'), ('sqerr', '<f8')]
+    INDEX = numpy.dtype([('security', '<i8'), ('date', '<i8'), ('field', 'S8'), ('cost', '<f8'), ('length', '<i4'), ('max_length', '<i4'), ('offset', '<i8'), ('count', '<i4'), ('total', '<f8')])
+
+    def __init__(self, path):
+        import os
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.pending = collections.OrderedDict()
+        self.open()
+
+    # Maps the files as they are on disk and rebuilds the key -> (offset, count) lookup
+    def open(self):
+        self.columns = {}
+        for name, dtype in self.COLUMNS:
+            self.columns[name] = self.map(name, numpy.dtype(dtype))
+        self.index = self.map('index', self.INDEX)
+        self.rows = len(self.columns['start'])
+        self.lookup = {}
+        for n, record in enumerate(self.index):
+            self.lookup[(int(record['security']), int(record['date']), record['field'], float(record['cost']), int(record['length']), int(record['max_length']))] = n
+
+    def map(self, name, dtype):
+        import os
+        filename = os.path.join(self.path, name)
+        if not os.path.exists(filename) or os.path.getsize(filename) < dtype.itemsize:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(filename, dtype=dtype, mode='r')
+
+    def key(self, security, date, field, cost, length, max_length):
+        # Quantopian securities are identified by their sid. Anything else (a symbol, say) is
+        # hashed into the negative numbers, which sids never use
+        sid = getattr(security, 'sid', security)
+        if hasattr(sid, '__index__'):
+            security = int(sid)
+        else:
+            security = -1 - int(hashlib.sha1(str(sid).encode('utf-8')).hexdigest()[:15], 16)
+        if hasattr(date, 'date'):
+            date = date.date()
+        if not isinstance(date, (int, numpy.integer)):
+            date = numpy.datetime64(date, 'D').astype('i8')
+        return (security, int(date), field.encode('ascii')[:8], float(cost), int(length), -1 if max_length is None else int(max_length))
+
+    # Returns the stored SegmentationResult of a window of `length` points segmented with
+    # segments of at most max_length points (None for no cap), or None. Its columns
+    # are slices of the mapped files. The segments have no endpoints unless the window itself
+    # is given as `points` (see as_xy)
+    def get(self, security, date, field, cost, length, max_length, points=None):
+        key = self.key(security, date, field, cost, length, max_length)
+        if key in self.pending:
+            return self.pending[key]
+        n = self.lookup.get(key)
+        if n is None:
+            return None
+
+        record = self.index[n]
+        rows = slice(record['offset'], record['offset'] + record['count'])
+        start, end, slope, intercept, sqerr = [self.columns[name][rows] for name, dtype in self.COLUMNS]
+        x = y = None
+        if points is not None:
+            x, y = as_xy(points)
+        total = float(record['total'])
+        return SegmentationResult(start, end, slope, intercept, sqerr, None if numpy.isnan(total) else total, x, y)
+
+    def put(self, security, date, field, cost, length, max_length, segments):
+        self.pending[self.key(security, date, field, cost, length, max_length)] = segments
+
+    # Appends everything put() since the last flush to the files and maps them again
+    def flush(self):
+        import os
+        if not self.pending:
+            return
+        records = numpy.zeros(len(self.pending), dtype=self.INDEX)
+        offset = self.rows
+        for n, (key, segments) in enumerate(self.pending.items()):
+            records[n] = key + (offset, len(segments), numpy.nan if segments.cost is None else segments.cost)
+            offset += len(segments)
+
+        for name, dtype in self.COLUMNS:
+            with open(os.path.join(self.path, name), 'ab') as f:
+                f.write(numpy.concatenate([numpy.asarray(getattr(segments, name), dtype=dtype) for segments in self.pending.values()]).tobytes())
+        with open(os.path.join(self.path, 'index'), 'ab') as f:
+            f.write(records.tobytes())
+
+        self.pending.clear()
+        self.open()
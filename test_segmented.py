@@ -0,0 +1,462 @@
+# Tests of segmented.py and segment_cli.py. Most of them check that a mode of segmented.py
+# finds the same optimal segmentation as the dense O(n^2) matrix path, which `bash test` in turn
+# checks against segmented.cpp. Runs under pytest or on its own:
+#
+#   python test_segmented.py
+#
+# The series are small random walks and noisy trends with float values, so ties between two
+# optimal solutions (where modes may legitimately pick different ones) don't come up
+
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+import numpy
+import pandas
+
+import segment_cli
+import segmented
+
+SEEDS = range(12)
+COSTS = [0.5, 4, 50]
+
+def make_series(seed, n=None):
+    r = random.Random(seed)
+    n = r.randint(1, 150) if n is None else n
+    if seed % 2 == 0:
+        y = numpy.cumsum([r.gauss(0, 1) for k in range(n)])
+    else:
+        y = numpy.array([0.3 * k * (1 if (k // 25) % 2 else -1) + r.gauss(0, 2) for k in range(n)])
+    return numpy.arange(n, dtype=float), y
+
+def cases():
+    for seed in SEEDS:
+        x, y = make_series(seed)
+        for C in COSTS:
+            yield seed, C, x, y
+
+# The dense path: the full error matrix and opt_recurrence(), with the segments longer than
+# max_length ruled out by an infinite error
+def dense(x, y, C, max_length=None):
+    N = len(x)
+    cumulative = segmented.prefix_sums(x, y)
+    E = segmented.error_matrix(cumulative, N)
+    if max_length is not None:
+        i, j = numpy.indices(E.shape)
+        E[j - i + 1 > max_length] = numpy.inf
+    OPT, opt_segment = segmented.opt_recurrence(E, N, C)
+    return segmented.fit_segments(cumulative, segmented.backtrack(opt_segment, N), x, y, float(OPT[N]))
+
+# The least square error of a line through points i..j (inclusive)
+def line_error(x, y, i, j):
+    if j == i:
+        return 0.0
+    slope, intercept = numpy.polyfit(x[i:j+1], y[i:j+1], 1)
+    return float(numpy.sum((y[i:j+1] - slope * x[i:j+1] - intercept) ** 2))
+
+def bounds(segments):
+    return [(int(segment.start), int(segment.end)) for segment in segments]
+
+def total(segments, C):
+    return sum(segment.sqerr for segment in segments) + C * len(segments)
+
+def assert_same(result, expected, C, context):
+    assert bounds(result) == bounds(expected), "%s: %s != %s" % (context, bounds(result), bounds(expected))
+    assert abs(total(result, C) - total(expected, C)) <= 1e-8 * max(1.0, abs(total(expected, C))), context
+    assert numpy.allclose([s.slope for s in result], [s.slope for s in expected]), context
+    assert numpy.allclose([s.intercept for s in result], [s.intercept for s in expected]), context
+
+# The message of the error function(*args) raises
+def raises(error, function, *args):
+    try:
+        function(*args)
+    except error as e:
+        return str(e)
+    assert False, "%s%r didn't raise %s" % (function.__name__, args, error.__name__)
+
+def test_dense_cost_is_the_total():
+    for seed, C, x, y in cases():
+        result = segmented.segmented((x, y), C)
+        assert abs(result.cost - total(result, C)) <= 1e-8 * max(1.0, result.cost), (seed, C)
+
+def test_pruned():
+    for seed, C, x, y in cases():
+        assert_same(segmented.segmented((x, y), C, pruned=True), dense(x, y, C), C, ('pruned', seed, C))
+
+def test_low_memory():
+    for seed, C, x, y in cases():
+        assert_same(segmented.segmented((x, y), C, low_memory=True), dense(x, y, C), C, ('low_memory', seed, C))
+
+def test_banded():
+    for seed, C, x, y in cases():
+        for L in (1, 5, 20):
+            expected = dense(x, y, C, max_length=L)
+            assert_same(segmented.segmented((x, y), C, max_length=L), expected, C, ('banded', seed, C, L))
+            assert_same(segmented.segmented((x, y), C, pruned=True, max_length=L), expected, C, ('pruned banded', seed, C, L))
+            assert_same(segmented.segmented((x, y), C, low_memory=True, max_length=L), expected, C, ('low_memory banded', seed, C, L))
+
+def test_batch():
+    for seed in SEEDS:
+        series = numpy.array([make_series(seed * 10 + s, 80)[1] for s in range(5)])
+        x = numpy.arange(80, dtype=float)
+        for C in COSTS:
+            for L in (None, 10):
+                for s, result in enumerate(segmented.segmented_batch(series, C, max_length=L)):
+                    assert_same(result, dense(x, series[s], C, L), C, ('batch', seed, C, L, s))
+
+def test_streaming():
+    for seed, C, x, y in cases():
+        points = [segmented.Point(a, b) for a, b in zip(x, y)]
+        assert_same(list(segmented.stream_segments(points, C)), dense(x, y, C), C, ('streaming', seed, C))
+
+# The joint error of a segment is the sum of its errors in every series, so the dense reference
+# runs opt_recurrence() over the sum of the series' error matrices
+def test_joint():
+    for seed in SEEDS:
+        x, high = make_series(seed, 90)
+        low = high - 1 - numpy.abs(make_series(seed + 100, 90)[1])
+        N = len(x)
+        for C in COSTS:
+            sums = [segmented.prefix_sums(x, y) for y in (high, low)]
+            E = segmented.error_matrix(sums[0], N) + segmented.error_matrix(sums[1], N)
+            OPT, opt_segment = segmented.opt_recurrence(E, N, C)
+            expected = segmented.backtrack(opt_segment, N)
+            results = segmented.segmented_joint(numpy.array([high, low]), C)
+            for k, y in enumerate((high, low)):
+                assert bounds(results[k]) == [(i - 1, j - 1) for i, j in expected], ('joint', seed, C)
+                assert abs(results[k].cost - OPT[N]) <= 1e-8 * max(1.0, OPT[N]), ('joint', seed, C)
+            # a single series segmented jointly is segmented on its own
+            assert_same(segmented.segmented_joint(high[numpy.newaxis], C)[0], dense(x, high, C), C, ('joint single', seed, C))
+
+def test_rolling():
+    r = random.Random(0)
+    y = numpy.cumsum([r.gauss(0, 1) for k in range(200)])
+    lookback = 40
+    windows = numpy.array([y[t:t + lookback] for t in range(0, 160)])
+    single = segmented.RollingSegmenter(4, lookback)
+    batch = segmented.RollingBatchSegmenter(4, lookback)
+    x = numpy.arange(lookback, dtype=float)
+    for t in range(len(windows) - 1):
+        expected = dense(x, windows[t], 4)
+        assert_same(single.segment(windows[t]), expected, 4, ('rolling', t))
+        # two securities, the second one a bar behind
+        results = batch.segment(['A', 'B'], windows[[t + 1, t]])
+        assert_same(results[1], expected, 4, ('rolling batch', t))
+
+# Every form of points as_xy() takes gives the same segments
+def test_point_forms():
+    x, y = make_series(3, 40)
+    expected = dense(x, y, 4)
+    points = [segmented.Point(a, b) for a, b in zip(x, y)]
+    for form in (points, tuple(points), (x, y), (list(x), list(y)), y):
+        assert_same(segmented.segmented(form, 4), expected, 4, ('points', type(form)))
+    two = (segmented.Point(0, 1), segmented.Point(1, 3))
+    assert bounds(segmented.segmented(two, 1)) == [(0, 1)]
+
+# A SegmentStore gives back what was put() before and after flush() and in a new store opened on
+# the same directory, keyed apart by max_length and by sid or symbol
+def test_store_round_trip():
+    x, y = make_series(4, 80)
+    full = segmented.segmented((x, y), 4)
+    banded = segmented.segmented((x, y), 4, max_length=20)
+    path = tempfile.mkdtemp()
+    try:
+        store = segmented.SegmentStore(path)
+        store.put(24, '2016-01-04', 'high', 4, 80, None, full)
+        store.put('SPY', '2016-01-04', 'high', 4, 80, 20, banded)
+        assert store.get(24, '2016-01-04', 'high', 4, 80, None) is full
+        store.flush()
+        for store in (store, segmented.SegmentStore(path)):
+            assert store.get(24, '2016-01-04', 'high', 4, 80, 20) is None
+            assert store.get(24, '2016-01-05', 'high', 4, 80, None) is None
+            assert store.get('SPY', '2016-01-04', 'low', 4, 80, 20) is None
+            for security, max_length, expected in ((24, None, full), ('SPY', 20, banded)):
+                result = store.get(security, '2016-01-04', 'high', 4, 80, max_length, (x, y))
+                assert bounds(result) == bounds(expected), (security, bounds(result))
+                assert numpy.allclose(result.slope, expected.slope) and numpy.allclose(result.sqerr, expected.sqerr)
+                assert abs(result.cost - expected.cost) <= 1e-9 * abs(expected.cost)
+                assert result[-1].p2.y == y[-1]
+    finally:
+        shutil.rmtree(path)
+
+# segmented_k() against every way to cut a short series into k segments
+def test_segmented_k():
+    for seed in SEEDS:
+        x, y = make_series(seed, 10)
+        least = {}
+        for cuts in itertools.product([False, True], repeat=len(x) - 1):
+            starts = [0] + [n + 1 for n in range(len(cuts)) if cuts[n]]
+            ends = [n - 1 for n in starts[1:]] + [len(x) - 1]
+            error = sum(line_error(x, y, i, j) for i, j in zip(starts, ends))
+            least[len(starts)] = min(least.get(len(starts), numpy.inf), error)
+        for K in (1, 3, 10, 20):
+            result, errors = segmented.segmented_k((x, y), K)
+            assert len(errors) == min(K, len(x))
+            assert numpy.allclose(errors, [least[k] for k in range(1, len(errors) + 1)], atol=1e-8), (seed, K)
+            assert len(result) <= K and abs(result.cost - min(errors)) <= 1e-8 * max(1.0, min(errors)), (seed, K)
+            assert abs(total(result, 0) - result.cost) <= 1e-8 * max(1.0, result.cost), (seed, K)
+
+# The intervals of segmented_path() cover [C_min, C_max] from the lowest cost up, and the
+# segments of each are the dense optimum at any cost inside it
+def test_segmented_path():
+    for seed in SEEDS:
+        x, y = make_series(seed, 60)
+        path = segmented.segmented_path((x, y), 0.1, 100)
+        assert path[0][0] == 0.1 and path[-1][1] == 100, seed
+        for (C_low, C_high, segments), following in zip(path, path[1:] + [None]):
+            assert C_low <= C_high and segments.cost is None, seed
+            if following is not None:
+                assert abs(following[0] - C_high) <= 1e-9 * C_high and len(following[2]) < len(segments), seed
+            for C in (C_low, (C_low + C_high) / 2, C_high):
+                expected = dense(x, y, C)
+                assert abs(total(segments, C) - expected.cost) <= 1e-8 * max(1.0, expected.cost), (seed, C)
+            C = (C_low + C_high) / 2
+            if C_low < C_high:
+                assert bounds(segments) == bounds(dense(x, y, C)), (seed, C)
+
+# SegmentationCache hits on the same series and options, misses on a different cost, option or
+# series, evicts the least recently used entry and returns the same segments as segmented()
+def test_cache():
+    cache = segmented.SegmentationCache(maxsize=2)
+    a, b, c = [make_series(seed, 50) for seed in (1, 2, 3)]
+    first = cache.segmented(a, 4)
+    assert cache.segmented((a[0].copy(), a[1].copy()), 4) is first
+    assert_same(first, dense(a[0], a[1], 4), 4, 'cache')
+    cache.segmented(a, 5)
+    cache.segmented(a, 4, max_length=10)
+    assert cache.stats()['evictions'] == 1
+    assert cache.segmented(a, 4, profiler=None) is not first
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['size']) == (1, 4, 2, 2), stats
+
+    # the least recently used one goes: b was read after c went in
+    cache = segmented.SegmentationCache(maxsize=2)
+    cache.segmented(b, 4)
+    cache.segmented(c, 4)
+    cache.segmented(b, 4)
+    cache.segmented(a, 4)
+    hits = cache.hits
+    cache.segmented(b, 4)
+    assert cache.hits == hits + 1
+    cache.segmented(c, 4)
+    assert cache.hits == hits + 1
+
+    # b and c are cached by now, and segmented_batch() shares the entries with segmented()
+    windows = numpy.array([b[1], c[1], b[1]])
+    results = cache.segmented_batch(windows, 4)
+    for window, result in zip(windows, results):
+        assert_same(result, dense(b[0], window, 4), 4, 'cache batch')
+    assert results[0] is results[2]
+
+# parse_series() and load_series() read every series of a file, whatever its format, and report
+# bad input with the file and line it is on
+def test_load_series():
+    series = segment_cli.parse_series("4\n0 1\n1 2.5\n\n  \n10\n0 -1\n", 'two')
+    assert [(C, list(x), list(y)) for C, x, y in series] == [(4, [0, 1], [1, 2.5]), (10, [0], [-1])]
+    assert segment_cli.parse_series("") == []
+    assert raises(ValueError, segment_cli.parse_series, "4\n0 1\n1\n", 'text') == 'text: line 3: expected a point "x y", got \'1\''
+    assert raises(ValueError, segment_cli.parse_series, "4\n0 1\n10\n0 1\n", 'text').startswith('text: line 3:')
+    assert raises(ValueError, segment_cli.parse_series, "4\n0 1\n\n1 2 3\n", 'text').startswith('text: line 4:')
+    assert raises(ValueError, segment_cli.parse_series, "4\n0 a\n", 'text').startswith('text: malformed series starting on line 1')
+    assert [segment_cli.number(v) for v in (3.0, 2.5, float('nan'), float('inf'))] == ['3', '2.5', 'nan', 'inf']
+
+    path = tempfile.mkdtemp()
+    try:
+        values = numpy.arange(12, dtype='<f8').reshape(3, 4)
+        numpy.save(os.path.join(path, 'a.npy'), values)
+        values.tofile(os.path.join(path, 'a.f8'))
+        with open(os.path.join(path, 'a.txt'), 'w') as f:
+            f.write("4\n0 1\n1 2\n")
+        with open(os.path.join(path, 'bad.txt'), 'wb') as f:
+            f.write(b"4\n0 \xff\xfe\n")
+
+        for filename, length in (('a.npy', None), ('a.f8', 4)):
+            series = segment_cli.load_series(os.path.join(path, filename), [1, 2, 3], length)
+            assert [C for C, x, y in series] == [1, 2, 3]
+            assert all(list(x) == [0, 1, 2, 3] and list(y) == list(row) for (C, x, y), row in zip(series, values))
+        assert len(segment_cli.load_series(os.path.join(path, 'a.f8'), 5)) == 1
+        assert segment_cli.load_series(os.path.join(path, 'a.txt'))[0][0] == 4
+        for args in (('a.f8', 5, 5), ('a.npy', [1, 2]), ('a.npy', None), ('bad.txt',)):
+            name = os.path.join(path, args[0])
+            assert raises(ValueError, segment_cli.load_series, name, *args[1:]).startswith(name + ': '), args
+    finally:
+        shutil.rmtree(path)
+
+# run_batch() writes a record per file in the order of the files, with one worker or several,
+# as JSON Lines or as .npz columns, and the segments are those of the dense path
+def test_run_batch():
+    path = tempfile.mkdtemp()
+    # run_batch() reports the missing file and a summary on stderr
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        values = numpy.array([make_series(seed, 40)[1] for seed in (1, 2, 3)])
+        numpy.save(os.path.join(path, 'a.npy'), values)
+        x, y = make_series(5, 30)
+        with open(os.path.join(path, 'b.txt'), 'w') as f:
+            f.write("4\n" + "".join("%r %r\n" % point for point in zip(x, y)))
+        files = [os.path.join(path, name) for name in ('a.npy', 'missing.npy', 'b.txt')]
+        expected = [(4.0, dense(numpy.arange(40.0), row, 4)) for row in values] + [(4.0, dense(x, y, 4))]
+
+        for jobs in (1, 2):
+            output = os.path.join(path, 'out.jsonl')
+            assert segment_cli.run_batch(files, output, jobs, cost=[4]) == 1
+            with open(output) as f:
+                records = [json.loads(line) for line in f]
+            assert [record['file'] for record in records] == files and 'error' in records[1]
+            series = records[0]['series'] + records[2]['series']
+            for record, (C, segments) in zip(series, expected):
+                assert record['cost'] == C and list(zip(record['start'], record['end'])) == bounds(segments)
+                assert numpy.allclose(record['slope'], segments.slope) and numpy.isclose(record['opt_cost'], segments.cost)
+
+            output = os.path.join(path, 'out.npz')
+            assert segment_cli.run_batch(files, output, jobs, cost=[4]) == 1
+            arrays = numpy.load(output)
+            assert list(arrays['file_name']) == files and list(arrays['series_file']) == [0, 0, 0, 2]
+            for n, (C, segments) in enumerate(expected):
+                rows = slice(arrays['series_offset'][n], arrays['series_offset'][n] + arrays['series_count'][n])
+                assert list(zip(arrays['start'][rows], arrays['end'][rows])) == bounds(segments)
+                assert numpy.allclose(arrays['sqerr'][rows], segments.sqerr)
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+        shutil.rmtree(path)
+
+# segmented_approx() cuts the whole series into contiguous segments whose cost is the one it
+# reports, never below the exact optimum, and is exact on series of up to coarse_size points
+def test_segmented_approx():
+    for seed in SEEDS:
+        x, y = make_series(seed, 400)
+        for C, coarse_size in ((4, 40), (50, 40), (4, 1000)):
+            result, gap = segmented.segmented_approx((x, y), C, coarse_size=coarse_size, exact=True)
+            spans = bounds(result)
+            assert spans[0][0] == 0 and spans[-1][1] == len(x) - 1, (seed, C)
+            assert all(end + 1 == start for (s, end), (start, e) in zip(spans, spans[1:])), (seed, C)
+            assert all(start <= end for start, end in spans), (seed, C)
+            assert abs(total(result, C) - result.cost) <= 1e-8 * result.cost, (seed, C)
+            assert gap >= -1e-8 * result.cost, (seed, C, gap)
+            assert abs(result.cost - gap - dense(x, y, C).cost) <= 1e-8 * result.cost, (seed, C)
+            if coarse_size >= len(x):
+                assert abs(gap) <= 1e-8 * result.cost, (seed, C, gap)
+            assert segmented.segmented_approx((x, y), C, coarse_size=coarse_size)[1] is None
+
+# screen_flags() gives every security the reason the scalar checks of handle_data() did, one
+# security at a time, NaN and infinite slopes and errors included
+def test_screen_flags():
+    class Context(object):
+        flag_tolerance_degrees = 25
+        min_positive_slope = 0.1
+        error_threshold = 2
+
+    def scalar(slope_high, slope_low, error_high):
+        if segmented.angle_between_slopes(slope_high, slope_low) < Context.flag_tolerance_degrees:
+            if numpy.mean([slope_high, slope_low]) > Context.min_positive_slope:
+                if error_high < Context.error_threshold:
+                    return segmented.FLAG_BUY
+                return segmented.REJECT_ERROR
+            return segmented.REJECT_NOT_POSITIVE
+        return segmented.REJECT_NOT_A_FLAG
+
+    nan, inf = float('nan'), float('inf')
+    slopes = [nan, inf, -inf, -0.3, 0.0, 0.05, 0.1, 0.2, 0.25, 1.0, 3.0]
+    cases = list(itertools.product(slopes, slopes, [nan, inf, 0.5, 2.0, 5.0]))
+    with numpy.errstate(invalid='ignore'):
+        expected = [scalar(*case) for case in cases]
+        slopes_high, slopes_low, errors_high = numpy.array(cases).T
+        reasons = segmented.screen_flags(Context(), slopes_high, slopes_low, errors_high)[0]
+    assert set(expected) == set([segmented.FLAG_BUY, segmented.REJECT_NOT_A_FLAG, segmented.REJECT_NOT_POSITIVE, segmented.REJECT_ERROR])
+    for case, reason, expected_reason in zip(cases, reasons, expected):
+        assert reason == expected_reason, (case, reason, expected_reason)
+
+# DecisionTelemetry counts every security by reason but leaves NaNs and infinities out of its
+# histograms, and clamps finite values outside the edges into the end bins
+def test_telemetry():
+    nan, inf = float('nan'), float('inf')
+    telemetry = segmented.DecisionTelemetry(samples=1)
+    reasons = numpy.array([segmented.FLAG_BUY, segmented.REJECT_ERROR, segmented.REJECT_ERROR, segmented.REJECT_NOT_A_FLAG])
+    for bar in range(2):
+        telemetry.record(['A', 'B', 'C', 'D'], reasons, numpy.array([10, nan, 5, 90]), numpy.array([0.5, nan, 7, -7]), numpy.array([1, inf, nan, 500]))
+    assert list(telemetry.counts) == [1, 1, 0, 2] and list(telemetry.totals) == [2, 2, 0, 4]
+    assert telemetry.summary() == "bar 2: 1 buy (A), 1 not a flag (D), 0 not positive, 2 error too high (B)"
+    assert (telemetry.angles.sum(), telemetry.slopes.sum(), telemetry.errors.sum()) == (6, 6, 4)
+    assert (telemetry.slopes[0], telemetry.slopes[-1], telemetry.errors[-1]) == (2, 2, 2)
+
+# plan_rebalance() only orders what changes the exposure of the portfolio
+def test_plan_rebalance():
+    class Position(object):
+        def __init__(self, amount, last_sale_price):
+            self.amount = amount
+            self.last_sale_price = last_sale_price
+
+    class Portfolio(object):
+        portfolio_value = 10000.0
+        positions = {'HELD': Position(20, 100), 'CLOSE': Position(10, 100), 'SHORT': Position(-5, 100), 'PENDING': Position(10, 100)}
+
+    class Context(object):
+        portfolio = Portfolio()
+
+    segmented.get_open_orders = lambda: {'PENDING': [object()], 'NEW_PENDING': [object()]}
+    try:
+        securities = ['NONE', 'HELD', 'CLOSE', 'SHORT', 'PENDING', 'NEW_PENDING', 'NEW']
+        # HELD is at 20% of the portfolio, CLOSE at 10% and SHORT at -5%
+        plan = segmented.plan_rebalance(Context(), securities, {'HELD': 0.203, 'NEW': 0.25, 'NEW_PENDING': 0.25, 'PENDING': 0.25}, 0.005)
+        assert plan == [('CLOSE', 0), ('SHORT', 0), ('NEW', 0.25)], plan
+        plan = segmented.plan_rebalance(Context(), securities, {'HELD': 0.21, 'CLOSE': 0.1}, 0.005)
+        assert plan == [('HELD', 0.21), ('SHORT', 0)], plan
+        plan = segmented.plan_rebalance(Context(), securities, {'HELD': 0.203})
+        assert plan == [('HELD', 0.203), ('CLOSE', 0), ('SHORT', 0)], plan
+    finally:
+        del segmented.get_open_orders
+
+# HistoryCache windows are the last `lookback` bars of history() every day, through skipped
+# days, bars seen twice and a universe that is reordered and gains and loses securities
+def test_history_cache():
+    r = random.Random(7)
+    names = ['SEC%d' % n for n in range(30)]
+    dates = pandas.date_range('2015-01-01', periods=300, freq='B')
+    frames = dict((field, pandas.DataFrame(numpy.random.RandomState(seed).randn(len(dates), len(names)), index=dates, columns=names)) for seed, field in enumerate(('high', 'low')))
+    today = [40]
+
+    def history(bar_count, frequency, field):
+        return frames[field].iloc[today[0] + 1 - bar_count:today[0] + 1]
+
+    for lookback in (1, 2, 20):
+        cache = segmented.HistoryCache(lookback)
+        securities = names[:10]
+        today[0] = 40
+        while today[0] < len(dates):
+            date, high, low = cache.update(securities, history)
+            assert date == dates[today[0]], (lookback, today[0])
+            for field, window in (('high', high), ('low', low)):
+                expected = frames[field][securities].values[today[0] + 1 - lookback:today[0] + 1].T
+                assert numpy.array_equal(window, expected), (lookback, today[0], field)
+
+            change = r.random()
+            if change < 0.1:
+                securities = r.sample(securities, len(securities))
+            elif change < 0.2:
+                securities = securities + r.sample([name for name in names if name not in securities], 2)
+            elif change < 0.3 and len(securities) > 3:
+                securities = r.sample(securities, len(securities) - 2)
+            step = r.random()
+            today[0] += 0 if step < 0.1 else r.randint(2, 4) if step < 0.2 else 1
+        assert cache.fetches['full'] < cache.fetches['bars'] / 2, cache.fetches
+
+def main():
+    failed = 0
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_') and callable(test):
+            try:
+                test()
+                print("PASSED %s" % name)
+            except AssertionError as e:
+                failed += 1
+                print("FAILED %s: %s" % (name, e))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()